@@ -1,19 +1,19 @@
 # region import
 import os
-import sqlite3
 import subprocess
 import threading
-import time
 import traceback
+from concurrent.futures import Future
 from signal import SIGINT
-from typing import Dict, List, Optional, overload
+from typing import Dict, FrozenSet, List, Optional, overload
 
-from telegram import (Bot, CallbackQuery, ChatMember, InlineKeyboardMarkup,
-                      Update)
+from telegram import (Bot, CallbackQuery, ChatMember, InlineKeyboardButton,
+                      InlineKeyboardMarkup, Update)
 from telegram.error import BadRequest, NetworkError, TimedOut
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
                           CommandHandler, Filters, MessageHandler, Updater)
 
+from sender import SEND_BACKGROUND, SEND_INTERACTIVE, messageSender
 from utils import *
 
 try:
@@ -39,6 +39,7 @@ class botLocks(object):
     def __init__(self) -> None:
         self.filelock = threading.Lock()
         self.botlock = threading.Lock()
+        self.blacklistlock = threading.Lock()
         self.buttonlock = multiLock(2)
 
 
@@ -57,11 +58,20 @@ class baseBot(object):
         self.bot: Bot = self.updater.bot
         self.workingMethod: Dict[int, str] = {}  # key为chat_id，而非user.id
         self.callbackDataServer = CallbackDataServer()
+        self.sender = messageSender(
+            self.bot, send_retries, send_backoff, send_backoff_max,
+            send_global_rate, send_group_per_minute, send_workers)
 
-        self.blacklist: List[int] = []
-        self.readblacklist()
         self.debug = False
         self.locks = botLocks()
+        # 不可变集合，修改时整体替换，读取时不需要加锁
+        self.blacklist: FrozenSet[int] = frozenset()
+        self.blacklist_database = databaseManager(self, blacklistdatabase)
+        self.readblacklist()
+        if blacklist_watch_interval > 0:
+            self.updater.job_queue.run_repeating(
+                self.watchblacklist, interval=blacklist_watch_interval,
+                first=blacklist_watch_interval, name="blacklist_watch")
 
     @property
     def lastchat(self) -> int:
@@ -89,32 +99,31 @@ class baseBot(object):
 
     def startup(self) -> None:
         self.importHandlers()
-        self.reply(MYID, "Bot is live!")
+        self.reply_nowait(MYID, "Bot is live!")
         self.updater.start_polling(drop_pending_updates=True)
         self.updater.idle()
 
-    def readblacklist(self):
-        self.blacklist = []
-        conn = sqlite3.connect(blacklistdatabase)
-        c = conn.cursor()
-        cur = c.execute("SELECT * FROM BLACKLIST;")
-        ans = cur.fetchall()
-        conn.close()
-        for tgid in ans:
-            self.blacklist.append(tgid)
+    def readblacklist(self) -> int:
+        """从数据库重新读取黑名单，返回黑名单的人数"""
+        with self.locks.blacklistlock:
+            # 还在排队的修改先写进数据库，以免读到的名单缺少它们
+            self.blacklist_database.flush()
+            ans = self.blacklist_database.select("BLACKLIST", need=["TGID"])
+            self.blacklist = frozenset(r[0] for r in ans)
+            return len(self.blacklist)
 
     def addblacklist(self, id: int):
-        if id in self.blacklist:
-            return
-        self.blacklist.append(id)
-        conn = sqlite3.connect(blacklistdatabase)
-        c = conn.cursor()
-        c.execute(
-            f"""INSERT INTO BLACKLIST(TGID)
-        VALUES({id});"""
-        )
-        conn.commit()
-        conn.close()
+        with self.locks.blacklistlock:
+            if id in self.blacklist:
+                return
+            self.blacklist = self.blacklist | {id}
+            # 在锁内排队，与`readblacklist`的flush和重新读取保持先后顺序
+            self.blacklist_database.insertLater("BLACKLIST", {"TGID": id})
+
+    def watchblacklist(self, context: CallbackContext) -> None:
+        """数据库被其他程序修改时重新读取黑名单"""
+        if self.blacklist_database.changed():
+            self.debuginfo(f"黑名单已重新读取，共{self.readblacklist()}个")
 
     def renewStatus(self, update: Update) -> "AntaresBot":
         """
@@ -147,30 +156,21 @@ class baseBot(object):
         """
         return self
 
-    def _reply_retries(self, retries: int = 5, sleeptime: int = 5, kwargs: dict = {}) -> int:
-        for i in range(retries):
-            try:
-                ans = self.bot.send_message(**kwargs).message_id
-            except Exception as e:
-                if (
-                    e.__class__ is BadRequest
-                    and str(e).find("Replied message not found") != -1
-                ):
-                    dictpop(kwargs, "reply_to_message_id")
-                    i -= 1
-                    continue
-
-                elif e.__class__ is BadRequest:
-                    raise e
+    def _send(
+        self, payloads: List[dict], method: str = "send_message", priority: int = SEND_INTERACTIVE
+    ) -> int:
+        """把`payloads`放进发送队列，等到发送完成，返回最后一条消息的message id"""
+        return self.sender.send(payloads, method, priority).result()
 
-                elif i == retries - 1:
-                    raise e
+    def _nowait(self, future: Future, priority: int) -> None:
+        """不等待发送结果，失败时用debuginfo报告"""
+        # 后台消息发送失败时不再用debuginfo报告，以免失败的消息越来越多
+        if priority == SEND_INTERACTIVE:
+            future.add_done_callback(self._sendDone)
 
-                time.sleep(sleeptime)
-
-            else:
-                break
-        return ans
+    def _sendDone(self, future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            self.debuginfo(f"发送消息失败：{future.exception()}")
 
     @overload
     def reply(
@@ -181,6 +181,7 @@ class baseBot(object):
         reply_to_message_id: int,
         parse_mode: str,
         timeout: int,
+        priority: int,
     ) -> int:
         ...
 
@@ -189,9 +190,19 @@ class baseBot(object):
         调用send_message方法，回复或发送消息。
         支持telegram bot中`send_message`方法的keyword argument，
         如`reply_markup`，`reply_to_message_id`，`parse_mode`，`timeout`。
-        返回值是message id
+        消息经过发送队列，等到发送完成，返回值是message id.
+        `priority`为`SEND_BACKGROUND`的消息排在其他消息之后
         """
-        ans = None
+        return self.reply_future(*args, **kwargs).result()
+
+    def reply_nowait(self, *args, **kwargs) -> None:
+        """与`reply`相同，但消息进入发送队列后立即返回，不等待发送和重试"""
+        priority = kwargs.get("priority", SEND_INTERACTIVE)
+        self._nowait(self.reply_future(*args, **kwargs), priority)
+
+    def reply_future(self, *args, **kwargs) -> Future:
+        """与`reply`相同，但返回message id的future"""
+        priority = kwargs.pop("priority", SEND_INTERACTIVE)
         chat_id: Optional[int] = None
         text: str = None
         if len(args) > 0:
@@ -220,44 +231,78 @@ class baseBot(object):
             if self.lastmsgid >= 0 and "reply_to_message_id" not in kwargs:
                 kwargs["reply_to_message_id"] = self.lastmsgid
 
-        txts = text.split("\n")
-
-        rp_markup = None
-        if len(text) >= 1000:
-            while len(txts) > 10 or len(text) >= 1000:
-                if "reply_markup" in kwargs:
-                    rp_markup = kwargs.pop("reply_markup")
-                if len(txts) > 10:
-                    line = 1
-                    l = len(txts[0])
-                    if l >= 1000:
-                        kwargs["text"] = text[:1000]
-                        text = text[1000:]
-                        txts = text.split("\n")
-                    else:
-                        while line <= 10 and l < 1000:
-                            l += len(txts[line])
-                            line += 1
-                        line -= 1
-                        kwargs["text"] = "\n".join(txts[:line])
-                        txts = txts[line:]
-                        text = "\n".join(txts)
-                else:
-                    kwargs["text"] = text[:1000]
-                    text = text[1000:]
-                    txts = text.split("\n")
-
-                ans = self._reply_retries(5, 5, kwargs)
-
-        if len(text) > 0:
-            kwargs["text"] = text
-            if rp_markup is not None:
-                kwargs["reply_markup"] = rp_markup
-            ans = self._reply_retries(5, 5, kwargs)
+        # 超长的文本分成多条消息，按钮只放在最后一条
+        chunks = splitMessage(text, MAX_MESSAGE_LENGTH, kwargs.get("parse_mode"))
+        rp_markup = kwargs.pop("reply_markup", None)
+        payloads = [dict(kwargs, text=chunk) for chunk in chunks]
+        if not payloads:
+            raise ValueError("发生错误：发送消息时没有文本")
+        if rp_markup is not None:
+            payloads[-1]["reply_markup"] = rp_markup
+        return self.sender.send(payloads, priority=priority)
 
-        if ans is None:
-            raise ValueError("没有成功发送消息")
-        return ans
+    @staticmethod
+    def pageMarkup(key: int, n: int, hasnext: bool, buttons: list) -> Optional[InlineKeyboardMarkup]:
+        nav = []
+        if n > 0:
+            nav.append(InlineKeyboardButton(
+                "上一页", callback_data=f"{PAGE_PREFIX}{key}:{n - 1}"))
+        if hasnext:
+            nav.append(InlineKeyboardButton(
+                "下一页", callback_data=f"{PAGE_PREFIX}{key}:{n + 1}"))
+        rows = [nav] + buttons if nav else buttons
+        return InlineKeyboardMarkup(rows) if rows else None
+
+    def replyPaged(
+        self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, pagesize: int = page_size,
+    ) -> int:
+        """
+        分页发送长文本：只发送第一页，附上翻页按钮。
+        后面的页在点击按钮时才切分出来，编辑到同一条消息中。
+        `reply_markup`中的按钮在每一页都会保留。返回值与`reply`相同
+        """
+        return self.replyPagedFuture(text, reply_markup, pagesize).result()
+
+    def replyPagedFuture(
+        self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, pagesize: int = page_size,
+    ) -> Future:
+        """与`replyPaged`相同，但返回message id的future"""
+        if not text:
+            raise ValueError("发生错误：发送消息时没有文本")
+        buttons = list(reply_markup.inline_keyboard) if reply_markup else []
+        kwargs = {"chat_id": self.lastchat}
+        if self.lastmsgid >= 0:
+            kwargs["reply_to_message_id"] = self.lastmsgid
+        if len(text) <= pagesize:
+            kwargs["text"] = text
+            if reply_markup is not None:
+                kwargs["reply_markup"] = reply_markup
+        else:
+            key = self.callbackDataServer.setPages(text, pagesize, buttons)
+            page, hasnext, _ = self.callbackDataServer.getPage(key, 0)
+            kwargs["text"] = page
+            kwargs["reply_markup"] = self.pageMarkup(key, 0, hasnext, buttons)
+        return self.sender.send([kwargs])
+
+    def turnPage(self, query: CallbackQuery) -> handleStatus:
+        """处理翻页按钮"""
+        if not query.data.startswith(PAGE_PREFIX):
+            return handlePassed
+        key, n = (int(x) for x in query.data[len(PAGE_PREFIX):].split(":"))
+        # 翻页编辑和其他消息一样经过发送队列限速
+        target = {"chat_id": query.message.chat_id,
+                  "message_id": query.message.message_id}
+        try:
+            page, hasnext, buttons = self.callbackDataServer.getPage(key, n)
+        except ValueError:
+            # 文本已经被挤出缓存，保留当前页，只去掉翻页按钮
+            self._nowait(self.sender.send(
+                [dict(target, reply_markup=None)], "edit_message_reply_markup"), SEND_INTERACTIVE)
+            return handleBlocked()
+        self._nowait(self.sender.send(
+            [dict(target, text=page, reply_markup=self.pageMarkup(key, n, hasnext, buttons))],
+            "edit_message_text"), SEND_INTERACTIVE)
+        return handleBlocked()
 
     @overload
     def reply_doc(
@@ -324,7 +369,8 @@ class baseBot(object):
             if type(document) is str and os.path.exists(document):
                 kwargs["document"] = open(document, "rb")
                 isfile = True
-            ans = self.bot.send_document(**kwargs).message_id
+            # 等到发送完成才能关闭文件
+            ans = self._send([kwargs], "send_document")
 
         if isfile:
             kwargs["document"].close()
@@ -395,7 +441,7 @@ class baseBot(object):
             if type(photo) is str and os.path.exists(photo):
                 kwargs["photo"] = open(photo, "rb")
                 isfile = True
-            ans = self.bot.send_photo(**kwargs).message_id
+            ans = self._send([kwargs], "send_photo")
 
         if isfile:
             kwargs["photo"].close()
@@ -420,12 +466,12 @@ class baseBot(object):
     def debuginfo(self, info: str, newth: bool = True) -> None:
         if self.debug and info != "":
             if newth:
-                threading.Thread(target=self.reply, args=(MYID, info)).start()
+                self.reply_nowait(MYID, info, priority=SEND_BACKGROUND)
             else:
-                self.reply(MYID, info)
+                self.reply(MYID, info, priority=SEND_BACKGROUND)
 
     def errorInfo(self, msg: str) -> False:
-        self.reply(text=msg)
+        self.reply_nowait(text=msg)
         return False
 
     def remove_job_if_exists(self, name: str) -> bool:
@@ -506,7 +552,7 @@ class baseBot(object):
     @commandCallbackMethod
     def cancel(self, update: Update, context: CallbackContext) -> None:
         if self.lastchat in self.workingMethod:
-            self.reply(text="操作取消～")
+            self.reply_nowait(text="操作取消～")
         dictpop(self.workingMethod, self.lastchat)
 
     def _before_stop(self):
@@ -514,24 +560,26 @@ class baseBot(object):
             self.beforestop()
         except:
             ...
+        self.blacklist_database.close()
 
     def _realstop(self):
         self.reply(MYID, text="主人再见QAQ")
+        self.sender.close()
         pid = os.getpid()
         os.kill(pid, SIGINT)
 
     @commandCallbackMethod
     def start(self, update: Update, context: CallbackContext) -> bool:
         if self.lastchat == MYID:
-            self.reply("❤️(ӦｖӦ｡) 主人，欢迎回家～")
+            self.reply_nowait("❤️(ӦｖӦ｡) 主人，欢迎回家～")
         else:
-            self.reply("有何贵干？")
+            self.reply_nowait("有何贵干？")
         return True
 
     @commandCallbackMethod
     def stop(self, update: Update, context: CallbackContext) -> bool:
         if not isfromme(update):
-            self.reply("你没有权限")
+            self.reply_nowait("你没有权限")
             return False
         self._before_stop()
         self._realstop()
@@ -540,13 +588,13 @@ class baseBot(object):
     @commandCallbackMethod
     def restart(self, update: Update, context: CallbackContext) -> bool:
         if not isfromme(update):
-            self.reply("你没有权限")
+            self.reply_nowait("你没有权限")
             return False
         self._before_stop()
         msg = str(subprocess.check_output(
             [startcommand], shell=True, encoding='utf-8'))
         if "Already up to date." not in msg:
-            self.reply(MYID, msg)
+            self.reply_nowait(MYID, msg)
         self._realstop()
 
     @commandCallbackMethod
@@ -554,30 +602,38 @@ class baseBot(object):
         if ischannel(update):
             return
         if isgroup(update) and update.message.reply_to_message is not None:
-            self.reply(
+            self.reply_nowait(
                 text=f"群id：`{self.lastchat}`\n回复的消息的用户id：`{update.message.reply_to_message.from_user.id}`",
                 parse_mode="MarkdownV2",
             )
         elif isgroup(update):
-            self.reply(
+            self.reply_nowait(
                 text=f"群id：`{self.lastchat}`\n您的id：`{self.lastuser}`",
                 parse_mode="MarkdownV2",
             )
         elif isprivate(update):
-            self.reply(text=f"您的id：\n{self.lastchat}", parse_mode="MarkdownV2")
+            self.reply_nowait(text=f"您的id：\n{self.lastchat}", parse_mode="MarkdownV2")
 
     @commandCallbackMethod
     def debugmode(self, update: Update, context: CallbackContext) -> None:
         if not isfromme(update):
-            self.reply("没有权限")
+            self.reply_nowait("没有权限")
             return
 
         if self.debug:
             self.debug = False
-            self.reply("Debug模式关闭")
+            self.reply_nowait("Debug模式关闭")
         else:
             self.debug = True
-            self.reply("Debug模式开启")
+            self.reply_nowait("Debug模式开启")
+
+    @commandCallbackMethod
+    def reloadblacklist(self, update: Update, context: CallbackContext) -> None:
+        if not isfromme(update):
+            self.reply_nowait("没有权限")
+            return
+
+        self.reply_nowait(f"黑名单已重新读取，共{self.readblacklist()}个")
 
     # 非指令的handlers，供子类重写。如果需要定义别的类型的handlers，务必在此处创建虚函数
 
@@ -600,8 +656,8 @@ class baseBot(object):
         return handlePassed
 
     def buttonHandler(self, update: Update, context: CallbackContext) -> handleStatus:
-        """Override"""
-        return handlePassed
+        """Override. 子类处理不了的按钮应交给这里，以便翻页按钮生效"""
+        return self.turnPage(update.callback_query)
 
     # 错误处理
     def errorHandler(self, update: object, context: CallbackContext):
@@ -609,12 +665,16 @@ class baseBot(object):
         if err.__class__ in [NetworkError, OSError, TimedOut, ConnectionError]:
             raise err
 
+        # 错误可能来自gpt事件循环等非dispatcher线程，此时没有正在处理的异常，
+        # 因此从异常对象本身取traceback
+        tb = "".join(traceback.format_exception(
+            err.__class__, err, err.__traceback__))
         text = f"哎呀，出现了未知的错误呢……\n{err.__class__}\n\
-                {err}\ntraceback:{traceback.format_exc()}"
+                {err}\ntraceback:{tb}"
         if len(text) > 5000:
             self.updater.logger.error(text)
             text = "哎呀，出现了未知的错误呢……错误过长，输出到日志里啦"
-        self.reply(
+        self.reply_nowait(
             chat_id=MYID,
             text=text,
         )
@@ -623,23 +683,22 @@ class baseBot(object):
     def unknowncommand(self, update: Update, context: CallbackContext):
         self = self.renewStatus(update)
         if not isfromme(update):
-            self.reply("没有这个指令")
+            self.reply_nowait("没有这个指令")
         else:
-            self.reply("似乎没有这个指令呢……")
+            self.reply_nowait("似乎没有这个指令呢……")
 
     # 聊天迁移
     @classmethod
     def chatmigrate(cls, oldchat: int, newchat: int, instance: "baseBot"):
         """Override"""
         if cls is baseBot:
-            conn = sqlite3.connect(blacklistdatabase)
-            c = conn.cursor()
-            c.execute(
-                f"""UPDATE BLACKLIST
-            SET TGID={newchat} WHERE TGID={oldchat}"""
-            )
-            if oldchat in instance.blacklist:
-                instance.blacklist[instance.blacklist.index(oldchat)] = newchat
+            with instance.locks.blacklistlock:
+                # 和`addblacklist`一样在锁内排队，`readblacklist`不会读到迁移前的id
+                instance.blacklist_database.executeLater(
+                    "UPDATE BLACKLIST SET TGID=? WHERE TGID=?;", (newchat, oldchat))
+                if oldchat in instance.blacklist:
+                    instance.blacklist = (
+                        instance.blacklist - {oldchat}) | {newchat}
 
     def beforestop(self):
         """Override"""
@@ -0,0 +1,44 @@
+"""
+黑名单查找的耗时：原来的`List[int]`和现在的`frozenset`.
+
+在仓库根目录运行::
+
+    python benchmarks/bench_blacklist.py
+
+黑名单有100k个id，每条update要检查发送者和聊天两个id，分别统计命中和不命中时的单次检查耗时，
+以及修改时整体复制集合的耗时。
+"""
+import random
+import time
+
+ENTRIES = 100000
+CHECKS = 2000
+
+
+def timeit(blacklist, ids) -> float:
+    t0 = time.perf_counter()
+    for user, chat in ids:
+        any(x in blacklist for x in (user, chat))
+    return (time.perf_counter() - t0) / len(ids) * 1e6
+
+
+def main():
+    rng = random.Random(1)
+    ids = rng.sample(range(1, 10**10), ENTRIES)
+    aslist = list(ids)
+    asset = frozenset(ids)
+    hits = [(rng.choice(ids), -rng.randrange(10**12)) for _ in range(CHECKS)]
+    misses = [(rng.randrange(10**10, 10**11), -rng.randrange(10**12))
+              for _ in range(CHECKS)]
+    print(f"{ENTRIES} ids, us per update check")
+    print(f"{'':<10}{'list':>10}{'frozenset':>12}")
+    for name, cases in (("hit", hits), ("miss", misses)):
+        print(f"{name:<10}{timeit(aslist, cases):>10.1f}{timeit(asset, cases):>12.3f}")
+    t0 = time.perf_counter()
+    for i in range(20):
+        asset = asset | {i}
+    print(f"copy-on-write add: {(time.perf_counter() - t0) / 20 * 1e3:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+`databaseManager`单次操作的耗时：原来每次拼接SQL、把非字符串的值直接写进语句、
+每次插入都查`PRAGMA table_info`的做法，和现在参数绑定、缓存语句与表结构的做法。
+批量插入比较原来逐行查询、插入、提交的`insertMany`和现在一个事务的`executemany`.
+
+在仓库根目录（需要有config.ini）运行::
+
+    python benchmarks/bench_database.py
+
+两种做法使用同样的长连接，只比较语句构造、编译和表结构查询的开销。
+"""
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import databaseManager  # noqa: E402
+
+ROWS = 5000
+
+
+class quietBot(object):
+    debug = False
+
+    def debuginfo(self, info: str, newth: bool = True) -> None:
+        ...
+
+
+class legacyManager(databaseManager):
+    """原来的语句构造方式"""
+
+    def _getPrimaryKey(self, table: str) -> str:
+        c = self.conn.cursor()
+        c.execute(f"PRAGMA table_info({table});")
+        for r in c.fetchall():
+            if r[-1] > 0:
+                return r[1]
+        return ""
+
+    @staticmethod
+    def _inline(where: Dict[str, Any], parseArgs: list) -> str:
+        l = []
+        for k, v in where.items():
+            if type(v) is str:
+                l.append(f"{k}=?")
+                parseArgs.append(v)
+            else:
+                l.append(f"{k}={v}")
+        return " AND ".join(l)
+
+    def _select(
+        self, table: str, where: Optional[Dict[str, Any]] = None, need: Optional[List[str]] = None,
+        conn=None,
+    ) -> list:
+        parseArgs: list = []
+        command = "SELECT " + \
+            ("*" if need is None else ", ".join(need)) + f" FROM {table}"
+        if where is not None:
+            command += " WHERE " + self._inline(where, parseArgs)
+        return (conn or self.conn).execute(command + ";", parseArgs).fetchall()
+
+    def _insert(self, table: str, datadict: dict):
+        parseArgs: list = []
+        values = []
+        for v in datadict.values():
+            if type(v) is str:
+                values.append("?")
+                parseArgs.append(v)
+            else:
+                values.append(str(v))
+        self.conn.execute(
+            f"INSERT INTO {table}({', '.join(datadict)}) VALUES({', '.join(values)});", parseArgs)
+        self.conn.commit()
+
+    def _update(self, table: str, datadict: dict, pkey: str):
+        parseArgs: list = []
+        sets = self._inline(
+            {k: v for k, v in datadict.items() if k != pkey}, parseArgs).replace(" AND ", ",")
+        where = self._inline({pkey: datadict[pkey]}, parseArgs)
+        self.conn.execute(
+            f"UPDATE {table} SET {sets} WHERE {where};", parseArgs)
+        self.conn.commit()
+
+    def insertMany(self, table: str, manydata: List[dict], no_pkey_check: bool = False):
+        """原来的逐行查询再插入或更新，每行提交一次"""
+        with self:
+            pk = self._getPrimaryKey(table)
+            for data in manydata:
+                if self._select(table, {pk: data[pk]}):
+                    self._update(table, data, pk)
+                else:
+                    self._insert(table, data)
+
+    def _delete(self, table: str, where: Optional[Dict[str, Any]] = None):
+        parseArgs: list = []
+        self.conn.execute(
+            f"DELETE FROM {table} WHERE {self._inline(where, parseArgs)};", parseArgs)
+        self.conn.commit()
+
+
+def bench(cls) -> Dict[str, float]:
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db = cls(quietBot(), path)
+    db.execute(
+        ["CREATE TABLE T (TGID INT NOT NULL PRIMARY KEY, NAME TEXT, SCORE INT);"])
+    ans = {}
+    rows = [{"TGID": i, "NAME": "user", "SCORE": i}
+            for i in range(ROWS, 2 * ROWS)]
+    t0 = time.perf_counter()
+    db.insertMany("T", rows)
+    ans["bulk"] = (time.perf_counter() - t0) / ROWS * 1e6
+    for name, op in (
+        ("insert", lambda i: db.insertInto(
+            "T", {"TGID": i, "NAME": "user", "SCORE": i})),
+        ("upsert", lambda i: db.insertInto(
+            "T", {"TGID": i, "NAME": "user", "SCORE": i + 1})),
+        ("select", lambda i: db.select("T", {"TGID": i})),
+        ("delete", lambda i: db.delete("T", {"TGID": i})),
+    ):
+        t0 = time.perf_counter()
+        for i in range(ROWS):
+            op(i)
+        ans[name] = (time.perf_counter() - t0) / ROWS * 1e6
+    db.close()
+    return ans
+
+
+def main():
+    before = bench(legacyManager)
+    after = bench(databaseManager)
+    print(f"{ROWS} ops each, us per op (bulk: insertMany of {ROWS} rows, per row)")
+    print(f"{'op':<8}{'before':>10}{'after':>10}")
+    for name in before:
+        print(f"{name:<8}{before[name]:>10.1f}{after[name]:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
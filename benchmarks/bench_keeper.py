@@ -0,0 +1,104 @@
+"""
+会话查找/创建的锁竞争测试。
+
+在仓库根目录（需要有config.ini）运行::
+
+    python benchmarks/bench_keeper.py
+
+对比旧的「一把全局锁，锁内创建会话」和分片+per-key future的实现，
+模拟多个chat同时发送第一条消息、bridge的`/newid`和`/create`各有固定延迟的情形。
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gptbot import OpenAICallingProxy, OpenAISessionKeeper  # noqa: E402
+from gptsession import sessionIdPool  # noqa: E402
+from utils import botmessages  # noqa: E402
+
+LATENCY = 0.02
+CHATS = 64
+THREADS = 8
+
+
+class fakeClient(object):
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.nextid = 0
+
+    def newid(self, ep) -> int:
+        time.sleep(LATENCY)
+        with self.lock:
+            self.nextid += 1
+            return self.nextid
+
+    def create(self, ep, sid: int) -> None:
+        time.sleep(LATENCY)
+
+    def stats(self):
+        return {}
+
+
+class globalLockKeeper(object):
+    """旧实现：查找和创建都在同一把锁里"""
+
+    def __init__(self) -> None:
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.client = fakeClient()
+
+    def _session(self, msg: botmessages, create: bool) -> OpenAICallingProxy:
+        with self.lock:
+            if msg not in self.sessions:
+                self.sessions[msg] = OpenAICallingProxy(
+                    self.client, None, None, self.client.newid(None))
+            return self.sessions[msg]
+
+
+def shardedKeeper(shards: int) -> OpenAISessionKeeper:
+    k = OpenAISessionKeeper(shards)
+    k.client = fakeClient()
+    k.pool = sessionIdPool(k._provision, 0, 0)
+    k.index.put = lambda *args: None
+    return k
+
+
+def run(keeper) -> float:
+    msgs = [botmessages(-1000 - i, 1) for i in range(CHATS)]
+    # 每个chat被两个线程同时请求，检查并发创建是否共享结果
+    work = msgs + msgs
+    it = iter(work)
+    itlock = threading.Lock()
+
+    def worker():
+        while True:
+            with itlock:
+                msg = next(it, None)
+            if msg is None:
+                return
+            keeper._session(msg, True)
+
+    threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - t0
+
+
+def main():
+    print(f"{CHATS} chats x 2 concurrent first messages, {THREADS} threads, "
+          f"{LATENCY * 1000:.0f}ms per bridge round trip")
+    old = globalLockKeeper()
+    print(f"global lock:      {run(old):.3f}s, sessions created: {old.client.nextid}")
+    for shards in (1, 16):
+        k = shardedKeeper(shards)
+        print(f"sharded ({shards:>2}):     {run(k):.3f}s, sessions created: {k.client.nextid}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+近似重复问题索引（`similarityIndex`）的查询延迟和内存测试。
+
+在仓库根目录（需要有config.ini）运行::
+
+    python benchmarks/bench_similar.py
+
+向索引写入100k条随机生成的问题，再分别查询改写过的已有问题（应命中）
+和全新的问题（应不命中），统计单次查询的延迟分位数和索引占用的内存。
+"""
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gptcache import similarityIndex  # noqa: E402
+
+ENTRIES = 100000
+QUERIES = 2000
+THRESHOLD = 0.8
+
+
+def makeWords(n: int):
+    rng = random.Random(1)
+    return ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9)))
+            for _ in range(n)]
+
+
+def makeQuestion(rng: random.Random, words) -> str:
+    return " ".join(rng.choice(words) for _ in range(rng.randint(5, 14)))
+
+
+def rephrase(rng: random.Random, question: str) -> str:
+    """改变大小写和标点，模拟用户换个写法再问一次"""
+    words = question.split()
+    i = rng.randrange(len(words))
+    words[i] = words[i].capitalize()
+    return " ".join(words) + rng.choice(["?", "？", "!", " ?", ""])
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return samples[n // 2] * 1e6, samples[int(n * 0.99)] * 1e6
+
+
+def main():
+    rng = random.Random(2)
+    words = makeWords(3000)
+    questions = [makeQuestion(rng, words) for _ in range(ENTRIES)]
+
+    tracemalloc.start()
+    index = similarityIndex(ENTRIES, THRESHOLD, 3600)
+    t0 = time.perf_counter()
+    for q in questions:
+        index.add(q, "answer", 1.0)
+    build = time.perf_counter() - t0
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{ENTRIES} entries added in {build:.1f}s with tracemalloc on "
+          f"({build / ENTRIES * 1e6:.0f}us each), index memory {memory / 2**20:.1f} MiB")
+
+    for name, queries, expect in (
+        ("rephrased", [rephrase(rng, rng.choice(questions))
+         for _ in range(QUERIES)], True),
+        ("new", [makeQuestion(rng, words) for _ in range(QUERIES)], False),
+    ):
+        times = []
+        correct = 0
+        for q in queries:
+            t0 = time.perf_counter()
+            found = index.find(q)
+            times.append(time.perf_counter() - t0)
+            correct += (found is not None) == expect
+        p50, p99 = percentiles(times)
+        print(f"{name:<10} p50 {p50:6.1f}us  p99 {p99:6.1f}us  "
+              f"{'hit' if expect else 'miss'} rate {correct / QUERIES:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+长消息切分的耗时测试：`baseBot.reply`原来的切分循环和`splitMessage`.
+
+在仓库根目录（需要有config.ini）运行::
+
+    python benchmarks/bench_split.py
+
+生成1KB到100KB、混有段落和代码块的文本，分别统计两种切分方式的耗时和切出的消息条数。
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import splitMessage  # noqa: E402
+
+SIZES = [1 << 10, 4 << 10, 16 << 10, 64 << 10, 100 << 10]
+
+
+def legacySplit(text: str):
+    """原来`reply`中的切分循环，只保留切分部分"""
+    ans = []
+    txts = text.split("\n")
+    if len(text) >= 1000:
+        while len(txts) > 10 or len(text) >= 1000:
+            if len(txts) > 10:
+                line = 1
+                l = len(txts[0])
+                if l >= 1000:
+                    ans.append(text[:1000])
+                    text = text[1000:]
+                    txts = text.split("\n")
+                else:
+                    while line <= 10 and l < 1000:
+                        l += len(txts[line])
+                        line += 1
+                    line -= 1
+                    ans.append("\n".join(txts[:line]))
+                    txts = txts[line:]
+                    text = "\n".join(txts)
+            else:
+                ans.append(text[:1000])
+                text = text[1000:]
+                txts = text.split("\n")
+    if len(text) > 0:
+        ans.append(text)
+    return ans
+
+
+def makeText(rng: random.Random, size: int) -> str:
+    parts = []
+    n = 0
+    while n < size:
+        if rng.random() < 0.2:
+            part = "```python\n" + \
+                "".join(f"x{i} = {i}\n" for i in range(rng.randint(3, 40))) + "```\n\n"
+        else:
+            part = " ".join("word" for _ in range(rng.randint(5, 60))) + \
+                rng.choice(["\n", "\n\n"])
+        parts.append(part)
+        n += len(part)
+    return "".join(parts)[:size]
+
+
+def timeit(f, text: str, parse_mode=None):
+    runs = max(3, 200000 // len(text))
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        chunks = f(text) if parse_mode is None else f(text, parse_mode=parse_mode)
+    return (time.perf_counter() - t0) / runs, len(chunks)
+
+
+def main():
+    rng = random.Random(1)
+    print(f"{'size':>7}  {'legacy':>18}  {'splitMessage':>18}  {'markdown':>18}")
+    for size in SIZES:
+        text = makeText(rng, size)
+        cols = [timeit(legacySplit, text), timeit(splitMessage, text),
+                timeit(splitMessage, text, "Markdown")]
+        print(f"{size // 1024:>5}KB  " + "  ".join(
+            f"{t * 1e6:9.1f}us {n:>3} msgs" for t, n in cols))
+
+
+if __name__ == "__main__":
+    main()
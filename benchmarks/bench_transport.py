@@ -0,0 +1,176 @@
+"""
+bridge传输方式的对比测试：loopback TCP和Unix domain socket.
+
+在仓库根目录（需要有config.ini）运行::
+
+    python benchmarks/bench_transport.py
+
+在子进程中启动一个最小的bridge（`/api`原样返回消息），分别通过TCP和Unix domain socket，
+用线程池版的`OpenAIBridgeClient`和事件循环中的`AsyncOpenAIBridgeClient`
+（`open_connection`和`open_unix_connection`）连续调用，统计单次调用的延迟分位数、吞吐，
+以及每次调用在客户端和bridge进程中消耗的CPU时间。
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bridge import AsyncOpenAIBridgeClient, OpenAIBridgeClient, bridgePool  # noqa: E402
+
+CALLS = 5000
+THREADS = 8
+PORT = 27987
+
+
+class handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        ...
+
+    def address_string(self) -> str:
+        return "bench"
+
+    def _send(self, body: str) -> None:
+        # 响应一次写出。头和体分两次写的话，TCP上每次调用都要多等一个delayed ACK
+        data = body.encode()
+        self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(data), data))
+
+    def do_GET(self) -> None:
+        self._send("1")
+
+    def do_POST(self) -> None:
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self._send(payload["msg"])
+
+
+class tcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class unixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(name: str, ready, stop) -> None:
+    if name.startswith("/"):
+        server = unixServer(name, handler)
+    else:
+        server = tcpServer(("127.0.0.1", PORT), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.set()
+    stop.wait()
+    server.shutdown()
+    server.server_close()
+    if name.startswith("/"):
+        os.unlink(name)
+
+
+def childcpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def runsync(pool: bridgePool, threads: int):
+    """`threads`个线程各自同步调用，返回(延迟列表, 新建连接数)"""
+    ep = pool.endpoints[0]
+    client = OpenAIBridgeClient(threads, pool)
+    client.api(ep, 1, "warmup")
+    latencies = []
+    lock = threading.Lock()
+    per = CALLS // threads
+
+    def worker():
+        mine = []
+        for _ in range(per):
+            t0 = time.perf_counter()
+            client.api(ep, 1, "hello")
+            mine.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return latencies, client.stats()["pool_misses"]
+
+
+def runasync(pool: bridgePool, threads: int):
+    """一个事件循环中`threads`个协程并发调用，返回(延迟列表, 新建连接数)"""
+    ep = pool.endpoints[0]
+    client = AsyncOpenAIBridgeClient(threads)
+    latencies = []
+    per = CALLS // threads
+
+    async def worker():
+        for _ in range(per):
+            t0 = time.perf_counter()
+            await client.api(ep, 1, "hello")
+            latencies.append(time.perf_counter() - t0)
+
+    async def run():
+        await client.api(ep, 1, "warmup")
+        await asyncio.gather(*(worker() for _ in range(threads)))
+        client.close()
+
+    asyncio.run(run())
+    return latencies, client.stats()["async_pool_misses"]
+
+
+def bench(name: str, threads: int, mode: str) -> None:
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    proc = multiprocessing.Process(target=serve, args=(name, ready, stop))
+    proc.start()
+    ready.wait()
+    pool = bridgePool([name])
+
+    cpu0 = time.process_time()
+    servercpu0 = childcpu()
+    t0 = time.perf_counter()
+    if mode == "async":
+        latencies, misses = runasync(pool, threads)
+    else:
+        latencies, misses = runsync(pool, threads)
+    elapsed = time.perf_counter() - t0
+    clientcpu = time.process_time() - cpu0
+    stop.set()
+    proc.join()
+    servercpu = childcpu() - servercpu0
+
+    latencies.sort()
+    n = len(latencies)
+    transport = "unix" if name.startswith("/") else "tcp"
+    print(f"{mode:<5} {transport:<5} {threads:>2} "
+          f"{'tasks' if mode == 'async' else 'threads'}: "
+          f"p50 {latencies[n // 2] * 1e6:7.1f}us  "
+          f"p99 {latencies[int(n * 0.99)] * 1e6:7.1f}us  "
+          f"{n / elapsed:8.0f} calls/s  "
+          f"cpu/call client {clientcpu / n * 1e6:6.1f}us "
+          f"bridge {servercpu / n * 1e6:6.1f}us  "
+          f"pool misses {misses}")
+
+
+def main():
+    print(f"{CALLS} /api calls per run")
+    sockpath = os.path.join(tempfile.mkdtemp(), "bridge.sock")
+    for mode in ("sync", "async"):
+        for threads in (1, THREADS):
+            bench(f"127.0.0.1:{PORT}", threads, mode)
+            bench(sockpath, threads, mode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,621 @@
+import asyncio
+import codecs
+import json
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import (Any, AsyncIterator, Callable, Deque, Dict, List,
+                    Optional, Tuple)
+from urllib.parse import quote, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool
+from urllib3.connection import HTTPConnection
+
+from cfg import *
+
+
+class GptBridgeException(Exception):
+    ...
+
+
+class GptBridgeUnavailableException(GptBridgeException):
+    ...
+
+
+class latencyTracker(object):
+    """最近若干次成功请求的耗时。样本足够时，用p95的`factor`倍作为超时时间"""
+
+    def __init__(self, default: float, floor: float = 5.0, factor: float = 3.0,
+                 minsamples: int = 20) -> None:
+        self.default = default
+        self.floor = floor
+        self.factor = factor
+        self.minsamples = minsamples
+        self.samples: Deque[float] = deque(maxlen=256)
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < self.minsamples:
+            return None
+        s = sorted(self.samples)
+        return s[int(len(s) * 0.95)]
+
+    def timeout(self) -> float:
+        p = self.p95()
+        if p is None:
+            return self.default
+        return min(self.default, max(self.floor, p * self.factor))
+
+
+class circuitBreaker(object):
+    """
+    bridge调用的熔断器，同步和异步客户端共用。
+    连续失败`threshold`次后进入open状态，之后`cooldown`秒内的调用直接抛出
+    `GptBridgeUnavailableException`；冷却结束后进入half-open，只放行一个探测请求，
+    成功则恢复closed，失败则重新open.
+    读超时按每个接口最近成功请求耗时的p95自适应调整，不超过配置的`read_timeout`.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openedat = 0.0
+        self.probing = False
+        self.opens = 0
+        self.shortcircuited = 0
+        self.latency: Dict[str, latencyTracker] = {}
+        self.onchange: Optional[Callable[[str, str], Any]] = None
+
+    def timeout(self, path: str) -> float:
+        return self._tracker(path).timeout()
+
+    def _tracker(self, path: str) -> latencyTracker:
+        path = path.split("?")[0]
+        if path not in self.latency:
+            self.latency[path] = latencyTracker(openai_read_timeout)
+        return self.latency[path]
+
+    def allows(self) -> bool:
+        """是否会放行新的请求（open状态冷却结束后会放行探测请求）"""
+        return self.state != self.OPEN or time.monotonic() - self.openedat >= self.cooldown
+
+    def before(self) -> None:
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.openedat < self.cooldown:
+                    self.shortcircuited += 1
+                    raise GptBridgeUnavailableException("bridge circuit open")
+                change = self._transition(self.HALF_OPEN)
+            else:
+                change = None
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    self.shortcircuited += 1
+                    raise GptBridgeUnavailableException("bridge circuit half-open")
+                self.probing = True
+        self._notify(change)
+
+    def success(self, path: Optional[str] = None, seconds: Optional[float] = None) -> None:
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            change = self._transition(self.CLOSED)
+            if path is not None and seconds is not None:
+                self._tracker(path).record(seconds)
+        self._notify(change)
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            change = None
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.threshold
+            ):
+                self.openedat = time.monotonic()
+                self.opens += 1
+                change = self._transition(self.OPEN)
+        self._notify(change)
+
+    def abandon(self) -> None:
+        """请求既没成功也没失败（例如被取消）时调用，释放half-open的探测名额"""
+        with self.lock:
+            self.probing = False
+
+    def _transition(self, state: str) -> Optional[Tuple[str, str]]:
+        if state == self.state:
+            return None
+        old, self.state = self.state, state
+        return old, state
+
+    def _notify(self, change: Optional[Tuple[str, str]]) -> None:
+        if change is not None and self.onchange is not None:
+            self.onchange(*change)
+
+    def stats(self, prefix: str = "") -> Dict[str, Any]:
+        ans: Dict[str, Any] = {
+            f"{prefix}breaker_state": self.state,
+            f"{prefix}breaker_opens": self.opens,
+            f"{prefix}breaker_shortcircuited": self.shortcircuited,
+        }
+        for path, tracker in self.latency.items():
+            ans[f"{prefix}timeout{path}"] = round(tracker.timeout(), 1)
+        return ans
+
+
+class _unixConnection(HTTPConnection):
+    def __init__(self, socketpath: str, **kwargs) -> None:
+        super().__init__("localhost", **kwargs)
+        self.socketpath = socketpath
+
+    def _new_conn(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socketpath)
+        except OSError as e:
+            sock.close()
+            raise e
+        return sock
+
+
+class _unixConnectionPool(HTTPConnectionPool):
+    def __init__(self, socketpath: str, **kwargs) -> None:
+        super().__init__("localhost", **kwargs)
+        self.socketpath = socketpath
+
+    def _new_conn(self) -> _unixConnection:
+        self.num_connections += 1
+        return _unixConnection(self.socketpath, timeout=self.timeout.connect_timeout)
+
+
+class unixSocketAdapter(HTTPAdapter):
+    """通过Unix domain socket连接bridge的adapter，只有一个连接池"""
+
+    def __init__(self, socketpath: str, pool_maxsize: int) -> None:
+        super().__init__(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.pool = _unixConnectionPool(socketpath, maxsize=pool_maxsize)
+
+    def get_connection(self, url, proxies=None) -> HTTPConnectionPool:
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None) -> HTTPConnectionPool:
+        return self.pool
+
+    def request_url(self, request, proxies) -> str:
+        return request.path_url
+
+    def close(self) -> None:
+        self.pool.close()
+        super().close()
+
+
+class bridgeEndpoint(object):
+    """
+    一个bridge进程。每个endpoint有自己的熔断器和未完成请求计数。
+    `name`为`host:port`时走TCP，以`/`开头时视为Unix domain socket的路径。
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        if name.startswith("/"):
+            self.socket: Optional[str] = name
+            self.host = "localhost"
+            self.port = 0
+            self.netloc = "localhost"
+            self.url = "http+unix://" + quote(name, safe="")
+        else:
+            self.socket = None
+            host, _, port = name.rpartition(":")
+            self.host = host
+            self.port = int(port)
+            self.netloc = f"{self.host}:{self.port}"
+            self.url = f"http://{self.netloc}"
+        self.breaker = circuitBreaker(breaker_threshold, breaker_cooldown)
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.healthy = True
+
+    @contextmanager
+    def track(self):
+        with self.lock:
+            self.outstanding += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+
+    def available(self) -> bool:
+        return self.healthy and self.breaker.allows()
+
+    def stats(self) -> Dict[str, Any]:
+        prefix = f"[{self.name}] "
+        ans: Dict[str, Any] = {
+            f"{prefix}healthy": self.healthy,
+            f"{prefix}outstanding": self.outstanding,
+        }
+        ans.update(self.breaker.stats(prefix))
+        return ans
+
+
+class bridgePool(object):
+    """
+    多个bridge endpoint组成的池。
+    新会话分配给未完成请求最少的可用endpoint，之后该会话的所有请求都固定发往这个endpoint
+    （sid只在创建它的bridge上有效）。后台线程定期探测每个endpoint，
+    连接不上的endpoint不再分配新会话，直到探测恢复。
+    """
+
+    def __init__(self, names: List[str]) -> None:
+        self.endpoints = [bridgeEndpoint(name) for name in names]
+        self.byname = {ep.name: ep for ep in self.endpoints}
+        self.rr = 0
+        self.checker: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.onhealthchange: Optional[Callable[[bridgeEndpoint], Any]] = None
+
+    def get(self, name: str) -> Optional[bridgeEndpoint]:
+        return self.byname.get(name)
+
+    def choose(self) -> bridgeEndpoint:
+        n = len(self.endpoints)
+        self.rr = (self.rr + 1) % n
+        # 从轮转的位置开始找，未完成请求数相同时不总是选中第一个
+        candidates = [self.endpoints[(self.rr + i) % n] for i in range(n)]
+        candidates = [ep for ep in candidates if ep.available()]
+        if not candidates:
+            raise GptBridgeUnavailableException("no bridge endpoint available")
+        return min(candidates, key=lambda ep: ep.outstanding)
+
+    def start(self, interval: float) -> None:
+        if self.checker is not None or interval <= 0:
+            return
+        self.checker = threading.Thread(
+            target=self._checkloop, args=(interval,), name="bridge-health", daemon=True)
+        self.checker.start()
+
+    def _probe(self, ep: bridgeEndpoint) -> bool:
+        try:
+            if ep.socket is not None:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.settimeout(openai_connect_timeout)
+                    sock.connect(ep.socket)
+            else:
+                socket.create_connection(
+                    (ep.host, ep.port), openai_connect_timeout).close()
+        except OSError:
+            return False
+        return True
+
+    def _checkloop(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            for ep in self.endpoints:
+                healthy = self._probe(ep)
+                if healthy != ep.healthy:
+                    ep.healthy = healthy
+                    if self.onhealthchange is not None:
+                        self.onhealthchange(ep)
+
+    def close(self) -> None:
+        self.stopped.set()
+
+    def stats(self) -> Dict[str, Any]:
+        ans: Dict[str, Any] = {}
+        for ep in self.endpoints:
+            ans.update(ep.stats())
+        return ans
+
+
+class OpenAIBridgeClient(object):
+    """
+    GPT bridge的共享同步客户端。
+    所有请求共用一个`requests.Session`，每个endpoint的连接池大小与updater的worker数一致，
+    这样每个worker都能复用一条keep-alive连接，而不是每次请求都重新握手。
+    """
+
+    def __init__(self, poolsize: int, bridges: bridgePool) -> None:
+        self.bridges = bridges
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(
+            pool_connections=len(bridges.endpoints), pool_maxsize=poolsize, max_retries=0
+        )
+        self.session.mount("http://", self.adapter)
+        self.unixadapters: List[unixSocketAdapter] = []
+        for ep in bridges.endpoints:
+            if ep.socket is not None:
+                adapter = unixSocketAdapter(ep.socket, poolsize)
+                self.session.mount(ep.url + "/", adapter)
+                self.unixadapters.append(adapter)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def _failed(self, ep: bridgeEndpoint, e: Exception) -> GptBridgeException:
+        with self.lock:
+            self.errors += 1
+        ep.breaker.failure()
+        return GptBridgeException(f"OpenAI API error: {e}")
+
+    def _request(self, ep: bridgeEndpoint, method: str, path: str, **kwargs) -> requests.Response:
+        with self.lock:
+            self.calls += 1
+        breaker = ep.breaker
+        breaker.before()
+        start = time.monotonic()
+        try:
+            response = self.session.request(
+                method, ep.url + path,
+                timeout=(openai_connect_timeout, breaker.timeout(path)),
+                **kwargs
+            )
+        except requests.RequestException as e:
+            raise self._failed(ep, e) from e
+        except BaseException as e:
+            breaker.abandon()
+            raise e
+        if response.status_code >= 500:
+            response.close()
+            raise self._failed(ep, Exception(f"HTTP {response.status_code}"))
+        if response.status_code != 200:
+            response.close()
+            with self.lock:
+                self.errors += 1
+            breaker.success()
+            raise GptBridgeException(
+                f"OpenAI API error: HTTP {response.status_code}")
+        breaker.success(path, time.monotonic() - start)
+        return response
+
+    def newid(self, ep: bridgeEndpoint) -> int:
+        with ep.track():
+            return int(self._request(ep, "GET", "/newid").text)
+
+    def create(self, ep: bridgeEndpoint, sid: int) -> None:
+        with ep.track():
+            self._request(ep, "GET", "/create", params={"sid": sid})
+
+    def api(self, ep: bridgeEndpoint, sid: int, content: str) -> str:
+        with ep.track():
+            return self._request(ep, "POST", "/api", json={
+                "sid": sid,
+                "msg": content,
+                "ensure_id": True
+            }).text
+
+    def stats(self) -> Dict[str, int]:
+        """
+        连接池命中统计。`misses`是新建连接的次数，其余请求都复用了池中的连接。
+        """
+        pools = self.adapter.poolmanager.pools
+        allpools = [pools[key] for key in pools.keys()]
+        allpools += [adapter.pool for adapter in self.unixadapters]
+        misses = requests_sent = 0
+        for pool in allpools:
+            misses += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "pool_hits": max(requests_sent - misses, 0),
+            "pool_misses": misses,
+        }
+
+
+_connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class AsyncOpenAIBridgeClient(object):
+    """
+    `OpenAIBridgeClient`的asyncio版本，直接在asyncio stream上实现bridge用到的那一小部分HTTP/1.1，
+    一个请求在等待bridge时不占用任何线程。
+    每个endpoint的空闲keep-alive连接放在各自的池中复用，每个池最多保留`maxidle`条。
+
+    只能在`gptEventLoop`的事件循环中使用。
+    """
+
+    def __init__(self, maxidle: int) -> None:
+        self.maxidle = maxidle
+        self.idle: Dict[str, List[_connection]] = {}
+        self.calls = 0
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def _connect(self, ep: bridgeEndpoint, fresh: bool = False) -> Tuple[_connection, bool]:
+        idle = self.idle.setdefault(ep.name, [])
+        while idle and not fresh:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self.hits += 1
+                return (reader, writer), True
+            writer.close()
+        self.misses += 1
+        if ep.socket is not None:
+            opening = asyncio.open_unix_connection(ep.socket)
+        else:
+            opening = asyncio.open_connection(ep.host, ep.port)
+        conn = await asyncio.wait_for(opening, openai_connect_timeout)
+        return conn, False
+
+    def _release(self, ep: bridgeEndpoint, conn: _connection) -> None:
+        idle = self.idle.setdefault(ep.name, [])
+        if len(idle) < self.maxidle and not conn[1].is_closing():
+            idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def _readline(self, reader: asyncio.StreamReader, timeout: float = openai_read_timeout) -> bytes:
+        return await asyncio.wait_for(reader.readline(), timeout)
+
+    async def _send(self, ep: bridgeEndpoint, method: str, path: str, payload: Optional[dict]) -> Tuple[_connection, Dict[str, str]]:
+        body = b"" if payload is None else json.dumps(payload).encode()
+        head = (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {ep.netloc}\r\n"
+            "Connection: keep-alive\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode()
+        for attempt in range(2):
+            conn, reused = await self._connect(ep, fresh=attempt > 0)
+            reader, writer = conn
+            try:
+                writer.write(head + body)
+                await writer.drain()
+                status = await self._readline(reader, ep.breaker.timeout(path))
+            except BaseException as e:
+                writer.close()
+                if reused and isinstance(e, (ConnectionError, asyncio.IncompleteReadError)):
+                    continue
+                raise e
+            if not status:
+                # 复用的连接已经被bridge关闭，换一条新连接重试
+                writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise ConnectionError("bridge closed the connection")
+            break
+        try:
+            code = int(status.split()[1])
+            headers: Dict[str, str] = {}
+            while True:
+                line = await self._readline(reader)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+        except BaseException as e:
+            writer.close()
+            raise e
+        if code != 200:
+            writer.close()
+            raise GptBridgeException(f"OpenAI API error: HTTP {code}", code)
+        return conn, headers
+
+    async def _chunks(self, ep: bridgeEndpoint, conn: _connection, headers: Dict[str, str]) -> AsyncIterator[bytes]:
+        """逐块读取响应体，读完后把连接放回池中；中途出错或被取消时关闭连接"""
+        reader, writer = conn
+        reusable = headers.get("connection", "").lower() != "close"
+        try:
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                while True:
+                    size = int((await self._readline(reader)).split(b";")[0], 16)
+                    if size == 0:
+                        await self._readline(reader)
+                        break
+                    data = await asyncio.wait_for(reader.readexactly(size + 2), openai_read_timeout)
+                    yield data[:-2]
+            elif "content-length" in headers:
+                size = int(headers["content-length"])
+                if size:
+                    yield await asyncio.wait_for(reader.readexactly(size), openai_read_timeout)
+            else:
+                reusable = False
+                while True:
+                    data = await asyncio.wait_for(reader.read(65536), openai_read_timeout)
+                    if not data:
+                        break
+                    yield data
+        except BaseException as e:
+            writer.close()
+            raise e
+        if reusable:
+            self._release(ep, conn)
+        else:
+            writer.close()
+
+    def _failed(self, ep: bridgeEndpoint, e: BaseException) -> GptBridgeException:
+        """把请求中的异常转换成`GptBridgeException`并记录到endpoint的熔断器"""
+        self.errors += 1
+        if isinstance(e, GptBridgeException):
+            if len(e.args) > 1 and e.args[1] < 500:
+                ep.breaker.success()
+            else:
+                ep.breaker.failure()
+            return e
+        ep.breaker.failure()
+        return GptBridgeException(f"OpenAI API error: {e!r}")
+
+    async def _request(self, ep: bridgeEndpoint, method: str, path: str, payload: Optional[dict] = None) -> str:
+        self.calls += 1
+        ep.breaker.before()
+        start = time.monotonic()
+        try:
+            with ep.track():
+                conn, headers = await self._send(ep, method, path, payload)
+                body = b"".join([data async for data in self._chunks(ep, conn, headers)])
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError,
+                GptBridgeException) as e:
+            raise self._failed(ep, e) from e
+        except BaseException as e:
+            ep.breaker.abandon()
+            raise e
+        ep.breaker.success(path, time.monotonic() - start)
+        return body.decode("utf-8")
+
+    async def newid(self, ep: bridgeEndpoint) -> int:
+        return int(await self._request(ep, "GET", "/newid"))
+
+    async def create(self, ep: bridgeEndpoint, sid: int) -> None:
+        await self._request(ep, "GET", "/create?" + urlencode({"sid": sid}))
+
+    async def api(self, ep: bridgeEndpoint, sid: int, content: str) -> str:
+        return await self._request(ep, "POST", "/api", {
+            "sid": sid,
+            "msg": content,
+            "ensure_id": True
+        })
+
+    async def stream(self, ep: bridgeEndpoint, sid: int, content: str) -> AsyncIterator[str]:
+        self.calls += 1
+        ep.breaker.before()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        try:
+            with ep.track():
+                conn, headers = await self._send(ep, "POST", "/stream", {
+                    "sid": sid,
+                    "msg": content,
+                    "ensure_id": True
+                })
+                ep.breaker.success()
+                async for data in self._chunks(ep, conn, headers):
+                    piece = decoder.decode(data)
+                    if piece:
+                        yield piece
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError,
+                GptBridgeException) as e:
+            raise self._failed(ep, e) from e
+        except BaseException as e:
+            ep.breaker.abandon()
+            raise e
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+    def close(self) -> None:
+        for idle in self.idle.values():
+            for _, writer in idle:
+                writer.close()
+        self.idle.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "async_calls": self.calls,
+            "async_errors": self.errors,
+            "async_pool_hits": self.hits,
+            "async_pool_misses": self.misses,
+        }
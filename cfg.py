@@ -1,3 +1,4 @@
+import os
 from configparser import ConfigParser
 
 __all__ = [
@@ -7,8 +8,47 @@ __all__ = [
     "MYID",
     "blacklistdatabase",
     "startcommand",
+    "page_size",
+    "page_cache_size",
+    "send_retries",
+    "send_backoff",
+    "send_backoff_max",
+    "send_global_rate",
+    "send_group_per_minute",
+    "send_workers",
+    "blacklist_watch_interval",
     "openai_port",
     "gpt_database",
+    "openai_connect_timeout",
+    "openai_read_timeout",
+    "openai_stream",
+    "stream_edit_interval",
+    "stream_group_edit_interval",
+    "session_max_entries",
+    "session_ttl",
+    "gpt_session_database",
+    "session_pool_size",
+    "session_pool_lowwater",
+    "session_shards",
+    "gpt_senders",
+    "async_max_idle",
+    "gpt_debounce",
+    "gpt_max_concurrency",
+    "gpt_max_queue",
+    "gpt_chat_weights",
+    "breaker_threshold",
+    "breaker_cooldown",
+    "gpt_socket",
+    "gpt_endpoints",
+    "health_interval",
+    "gpt_cache_size",
+    "gpt_cache_ttl",
+    "gpt_similar_threshold",
+    "gpt_similar_size",
+    "gpt_share_timeout",
+    "session_lifetime",
+    "session_rotate_interval",
+    "gpt_paginate",
 ]
 
 cfgparser = ConfigParser()
@@ -21,11 +61,89 @@ proxy_url = cfgparser["settings"]["proxy_url"]
 MYID = cfgparser.getint("settings", "myid")
 blacklistdatabase = cfgparser["settings"]["blacklistdatabase"]
 startcommand = cfgparser["settings"]["startcommand"]
+# 分页发送长文本时每页的最大长度，以及最多保留多少篇文本供翻页
+page_size = min(cfgparser.getint(
+    "settings", "page_size", fallback=2000), 4096)
+page_cache_size = cfgparser.getint(
+    "settings", "page_cache_size", fallback=256)
+# 发送消息失败时的重试次数和指数退避的初始、最大间隔（秒）
+send_retries = cfgparser.getint("settings", "send_retries", fallback=5)
+send_backoff = cfgparser.getfloat("settings", "send_backoff", fallback=1.0)
+send_backoff_max = cfgparser.getfloat(
+    "settings", "send_backoff_max", fallback=60.0)
+# 发送队列的限速：全局每秒条数，每个群每分钟条数；调用Bot API的线程数
+send_global_rate = cfgparser.getfloat(
+    "settings", "send_global_rate", fallback=30.0)
+send_group_per_minute = cfgparser.getfloat(
+    "settings", "send_group_per_minute", fallback=20.0)
+send_workers = cfgparser.getint("settings", "send_workers", fallback=4)
+# 每隔多少秒检查黑名单数据库是否被其他程序修改，0表示不检查
+blacklist_watch_interval = cfgparser.getfloat(
+    "settings", "blacklist_watch_interval", fallback=0.0)
 # endregion
 
 # region gpt
 openai_port = cfgparser.getint("gpt", "port")
 gpt_database = cfgparser["gpt"]["database"]
+openai_connect_timeout = cfgparser.getfloat(
+    "gpt", "connect_timeout", fallback=3.0)
+openai_read_timeout = cfgparser.getfloat("gpt", "read_timeout", fallback=120.0)
+openai_stream = cfgparser.getboolean("gpt", "stream", fallback=False)
+stream_edit_interval = cfgparser.getfloat(
+    "gpt", "stream_edit_interval", fallback=1.0)
+stream_group_edit_interval = cfgparser.getfloat(
+    "gpt", "stream_group_edit_interval", fallback=3.0)
+session_max_entries = cfgparser.getint(
+    "gpt", "session_max_entries", fallback=10000)
+session_ttl = cfgparser.getfloat("gpt", "session_ttl", fallback=86400.0)
+gpt_session_database = cfgparser.get(
+    "gpt", "session_database",
+    fallback=os.path.join(os.path.dirname(gpt_database), "gpt_session.db"))
+session_pool_size = cfgparser.getint("gpt", "session_pool_size", fallback=4)
+session_pool_lowwater = cfgparser.getint(
+    "gpt", "session_pool_lowwater", fallback=2)
+session_shards = cfgparser.getint("gpt", "session_shards", fallback=16)
+gpt_senders = cfgparser.getint("gpt", "senders", fallback=4)
+async_max_idle = cfgparser.getint("gpt", "async_max_idle", fallback=64)
+gpt_max_concurrency = cfgparser.getint("gpt", "max_concurrency", fallback=32)
+gpt_max_queue = cfgparser.getint("gpt", "max_queue", fallback=64)
+# chat_weights=群号:权重, 群号:权重
+gpt_chat_weights = {
+    int(k): float(v)
+    for k, v in (
+        x.split(":") for x in cfgparser.get("gpt", "chat_weights", fallback="").split(",") if x.strip()
+    )
+}
+gpt_debounce = cfgparser.getfloat("gpt", "debounce", fallback=0.0)
+breaker_threshold = cfgparser.getint("gpt", "breaker_threshold", fallback=5)
+breaker_cooldown = cfgparser.getfloat("gpt", "breaker_cooldown", fallback=30.0)
+# socket=/path/to.sock：通过Unix domain socket连接本机的bridge，而不是`port`
+gpt_socket = cfgparser.get("gpt", "socket", fallback="")
+# endpoints=host:port, /path/to.sock；不填时只使用本机的bridge。
+# 同时填了socket时它也在列表中，并排在最前：旧版本记录的会话都在这个bridge上
+gpt_endpoints = [
+    x.strip() for x in cfgparser.get("gpt", "endpoints", fallback="").split(",") if x.strip()
+]
+if gpt_socket:
+    gpt_endpoints = [gpt_socket] + [x for x in gpt_endpoints if x != gpt_socket]
+gpt_endpoints = gpt_endpoints or [f"127.0.0.1:{openai_port}"]
+health_interval = cfgparser.getfloat("gpt", "health_interval", fallback=10.0)
+# 相同的第一轮提问直接使用缓存的回答，cache_size=0时关闭
+gpt_cache_size = cfgparser.getint("gpt", "cache_size", fallback=0)
+gpt_cache_ttl = cfgparser.getfloat("gpt", "cache_ttl", fallback=600.0)
+# 近似重复的问题也使用缓存（需要cache_size>0），similar_threshold=0时关闭
+gpt_similar_threshold = cfgparser.getfloat(
+    "gpt", "similar_threshold", fallback=0.0)
+gpt_similar_size = cfgparser.getint("gpt", "similar_size", fallback=10000)
+# 等待相同问题的回答最多`share_timeout`秒，超时后回复用户稍后再试
+gpt_share_timeout = cfgparser.getfloat("gpt", "share_timeout", fallback=300.0)
+# bridge会话创建后`session_lifetime`秒过期，后台任务每`session_rotate_interval`秒提前轮换快到期的会话
+session_lifetime = cfgparser.getfloat(
+    "gpt", "session_lifetime", fallback=86400.0)
+session_rotate_interval = cfgparser.getfloat(
+    "gpt", "session_rotate_interval", fallback=600.0)
+# 长回答只发送第一页，其余页通过按钮翻页
+gpt_paginate = cfgparser.getboolean("gpt", "paginate", fallback=False)
 # endregion
 
 del cfgparser
@@ -1,87 +1,597 @@
 from basebot import baseBot
+import asyncio
 import time
 import threading
-import requests
+from collections import deque
+from concurrent.futures import Future
+from typing import (AsyncGenerator, AsyncIterator, Awaitable, Callable, Deque, Optional,
+                    Tuple)
+from sender import SEND_INTERACTIVE
+from bridge import (AsyncOpenAIBridgeClient, GptBridgeException,
+                    OpenAIBridgeClient, bridgeEndpoint, bridgePool,
+                    circuitBreaker)
+from gptcache import responseCache, similarityIndex
+from gptloop import GptBusyException, admissionScheduler, gptEventLoop
+from gptsession import (GptSessionExpiredException,
+                        GptSessionNotFoundException, sessionIdPool,
+                        sessionIndex, sessionStore)
 from utils import *
-SECONDS_IN_A_DAY = 60 * 60 * 24
+GPT_UNAVAILABLE = "GPT服务暂时不可用，请稍后再试"
+GPT_FRESH_PREFIX = "gptfresh:"
+GPT_STOP_PREFIX = "gptstop:"
 
 
 class GptTokenExpireException(Exception):
     ...
 
 
+class GptCancelledException(Exception):
+    ...
+
+
+class gptRequest(object):
+    """
+    会话请求队列中的一项。`handler`是在事件循环中调用bridge并发送回答的协程函数。
+    带`tag`的请求在处理完之前登记在`OpenAISessionKeeper.active`中，可以被取消。
+    handler还没有开始运行就被取消时，在事件循环中调用`oncancel`.
+    """
+    __slots__ = ["chat", "user", "tag", "priority", "content", "handler", "onerror",
+                 "oncancel", "arrival", "task", "cancelled"]
+
+    def __init__(
+        self,
+        chat: int,
+        priority: bool,
+        content: str,
+        handler: Callable[["OpenAICallingProxy", str], Awaitable[Any]],
+        onerror: Callable[[Exception], Any],
+        user: int = 0,
+        tag: Optional[str] = None,
+    ) -> None:
+        self.chat = chat
+        self.user = user
+        self.tag = tag
+        self.priority = priority
+        self.content = content
+        self.handler = handler
+        self.onerror = onerror
+        self.oncancel: Optional[Callable[[], Any]] = None
+        self.arrival = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+
+
 class OpenAICallingProxy(object):
-    def __init__(self, sid: int) -> None:
-        self.lock = threading.Lock()
-        self.update(sid)
-
-    def call(self, content: str):
-        # if time.time() - self.timestamp > SECONDS_IN_A_DAY:
-        #     raise GptTokenExpireException()
-        with self.lock:
-            response = requests.post(
-                f"http://127.0.0.1:{openai_port}/api", json={
-                    "sid": self.sid,
-                    "msg": content,
-                    "ensure_id": True
-                })
-        if response.status_code != 200:
-            raise Exception("OpenAI API error")
-        return response.text
+    def __init__(
+        self,
+        client: OpenAIBridgeClient,
+        aclient: AsyncOpenAIBridgeClient,
+        endpoint: bridgeEndpoint,
+        sid: int,
+        create: bool = True,
+        created: Optional[float] = None,
+    ) -> None:
+        self.client = client
+        self.aclient = aclient
+        # sid只在创建它的bridge上有效，会话的所有请求都发往这个endpoint
+        self.endpoint = endpoint
+        # 请求队列只在gpt事件循环中访问，不需要加锁
+        self.queue: Deque[gptRequest] = deque()
+        self.draining = False
+        # 在缓存的回答上追问而创建的会话，第一次调用前先带上那一轮问答
+        self.prelude: Optional[str] = None
+        if create:
+            self.update(sid)
+        else:
+            # bridge上已经创建好的会话：预先创建的id，或重启后从持久化索引恢复。
+            # `created`是它在bridge上的创建时间
+            self.timestamp = time.time() if created is None else created
+            self.sid = sid
+
+    def expired(self) -> bool:
+        return time.time() - self.timestamp > session_lifetime
+
+    async def acall(self, content: str) -> str:
+        if self.expired():
+            raise GptTokenExpireException()
+        return await self.aclient.api(self.endpoint, self.sid, content)
+
+    def astream(self, content: str) -> AsyncIterator[str]:
+        if self.expired():
+            raise GptTokenExpireException()
+        return self.aclient.stream(self.endpoint, self.sid, content)
 
     def update(self, sid: int):
-        with self.lock:
-            self.timestamp = time.time()
-            self.sid = sid
-            response = requests.get(
-                f"http://127.0.0.1:{openai_port}/create?sid={self.sid}",
-            )
-            if response.status_code != 200:
-                raise Exception("OpenAI API error")
+        self.client.create(self.endpoint, sid)
+        self.replace(self.endpoint, sid)
 
+    def replace(self, endpoint: bridgeEndpoint, sid: int) -> None:
+        """换成一个已经在bridge上创建好的会话。已经在使用的会话只在`OpenAISessionKeeper.rotatelock`内替换"""
+        self.timestamp = time.time()
+        self.endpoint = endpoint
+        self.sid = sid
 
-class OpenAISessionKeeper(object):
-    def __init__(self) -> None:
-        self.sessions: Dict[botmessages, OpenAICallingProxy] = {}
+
+class _keeperShard(object):
+    __slots__ = ["lock", "sessions", "creating", "delivered"]
+
+    def __init__(self, maxentries: int, ttl: float) -> None:
         self.lock = threading.Lock()
+        self.sessions: sessionStore[OpenAICallingProxy] = sessionStore(
+            maxentries, ttl)
+        self.creating: Dict[botmessages, Future] = {}
+        # 从缓存发出的回答 -> 那一轮问答，被回复时才创建会话
+        self.delivered: sessionStore[str] = sessionStore(maxentries, ttl)
+
+
+class OpenAISessionKeeper(object):
+    """
+    会话按chat分片，每个分片有自己的锁，锁内只做内存操作。
+    创建或恢复会话的网络/磁盘I/O在锁外进行；同一个key的并发创建共享同一个`Future`，
+    只有第一个线程真正去创建，其余线程等待它的结果。
+    同一对话链的所有消息都在同一个chat中，因此总是落在同一个分片里。
+    """
+
+    def __init__(self, shards: int = session_shards) -> None:
+        perShard = max(1, -(-session_max_entries // shards))
+        self.shards: List[_keeperShard] = [
+            _keeperShard(perShard, session_ttl) for _ in range(shards)
+        ]
+        self.index = sessionIndex(gpt_session_database, session_ttl)
+        self.pool = sessionIdPool(
+            self._provision, session_pool_size, session_pool_lowwater, self._stale)
         self.bot: "gptBot" = None
+        self.client: OpenAIBridgeClient = None
+        self.bridges = bridgePool(gpt_endpoints)
+        for ep in self.bridges.endpoints:
+            ep.breaker.onchange = self._breakerwatcher(ep)
+        self.bridges.onhealthchange = self._onhealthchange
+        self.aclient = AsyncOpenAIBridgeClient(async_max_idle)
+        self.loop = gptEventLoop(gpt_senders)
+        self.scheduler = admissionScheduler(
+            gpt_max_concurrency, gpt_max_queue, gpt_chat_weights)
+        similar = None
+        if gpt_similar_threshold > 0:
+            similar = similarityIndex(
+                gpt_similar_size, gpt_similar_threshold, gpt_cache_ttl)
+        self.cache = responseCache(gpt_cache_size, gpt_cache_ttl, similar)
+        self.submitted = 0
+        # 可以取消的请求，tag -> 请求。只在gpt事件循环中访问
+        self.active: Dict[str, gptRequest] = {}
+        self.cancelled = 0
+        self.rotatelock = threading.Lock()
+        self.rotated = 0
+        self.rotatefailures = 0
+        self.merged = 0
+        self.inflight = 0
+
+    def _shard(self, msg: botmessages) -> _keeperShard:
+        return self.shards[hash(msg.chat) % len(self.shards)]
+
+    def _session(self, msg: botmessages, create: bool) -> OpenAICallingProxy:
+        shard = self._shard(msg)
+        with shard.lock:
+            try:
+                return shard.sessions.get(msg)
+            except GptSessionNotFoundException as e:
+                missing = e
+            prelude = None
+            if not create:
+                try:
+                    prelude = shard.delivered.get(msg)
+                except GptSessionNotFoundException:
+                    ...
+            future = shard.creating.get(msg)
+            if future is not None:
+                owner = False
+            else:
+                owner = True
+                future = shard.creating[msg] = Future()
+        if not owner:
+            return future.result()
 
-    def call(self, msg: botmessages, content: str):
-        with self.lock:
-            if msg not in self.sessions:
-                _u = OpenAICallingProxy(self._newId())
-                self.sessions[msg] = _u
-            t = self.sessions[msg]
         try:
-            return t.call(content)
+            if create or prelude is not None:
+                _u = self._create(msg)
+                _u.prelude = prelude
+            else:
+                _u = self._restore(msg, missing)
+        except BaseException as e:
+            with shard.lock:
+                shard.creating.pop(msg, None)
+            future.set_exception(e)
+            raise e
+        with shard.lock:
+            shard.sessions.add(msg, _u)
+            shard.creating.pop(msg, None)
+        future.set_result(_u)
+        return _u
+
+    def _create(self, msg: botmessages) -> OpenAICallingProxy:
+        while True:
+            pooled = self.pool.pop()
+            # 预先创建的id所在的bridge已经不可用时丢弃，换下一个
+            if pooled is None or pooled[0].available():
+                break
+        if pooled is not None:
+            ep, sid, created = pooled
+            _u = OpenAICallingProxy(
+                self.client, self.aclient, ep, sid, create=False, created=created)
+        else:
+            ep = self.bridges.choose()
+            _u = OpenAICallingProxy(
+                self.client, self.aclient, ep, self._newId(ep))
+        self.index.put(msg, ep.name, _u.sid, _u.timestamp)
+        return _u
+
+    def bind_cached(self, msg: botmessages, question: str, answer: str) -> None:
+        """
+        缓存的回答没有bridge会话。记下它对应的问答，
+        用户回复这条回答时再创建会话，并在第一次追问前带上这一轮问答。
+        """
+        shard = self._shard(msg)
+        with shard.lock:
+            shard.delivered.add(msg, f"问：{question}\n答：{answer}\n\n")
+
+    def _restore(self, msg: botmessages, missing: GptSessionNotFoundException) -> OpenAICallingProxy:
+        """内存中没有这个会话时，从持久化索引中恢复"""
+        record = self.index.get(msg)
+        if record is None:
+            raise missing
+        name, sid, ts, created = record
+        # 旧版本的记录没有endpoint，那时只有一个bridge
+        ep = self.bridges.endpoints[0] if name is None else self.bridges.get(
+            name)
+        if ep is None or self.index.expired(ts):
+            raise GptSessionExpiredException("session expired")
+        self.bot.debuginfo(f"session {sid}@{ep.name} restored for {msg}")
+        # 按bridge会话真正的创建时间计算寿命，轮换任务才能及时换掉它
+        return OpenAICallingProxy(
+            self.client, self.aclient, ep, sid, create=False, created=created)
+
+    def _renew(self, t: OpenAICallingProxy) -> None:
+        """轮换任务漏掉的会话在请求时同步续期，正常情况下不会走到这里"""
+        self.bot.debuginfo("token expired, renewing...")
+        keys = [key for shard in self.shards for value, keys in self._snapshot(shard)
+                if value is t for key in keys]
+        self._rotate(t, keys)
+
+    def _snapshot(self, shard: _keeperShard) -> List[Tuple[OpenAICallingProxy, List[botmessages]]]:
+        with shard.lock:
+            return shard.sessions.sessions()
+
+    def _rotate(self, t: OpenAICallingProxy, keys: List[botmessages]) -> None:
+        """为会话创建新的bridge会话并替换，持久化索引中的所有key一起改为新的sid"""
+        # 后台任务和请求中的续期可能同时轮换同一个会话，串行化以保证索引和会话一致
+        with self.rotatelock:
+            ep = t.endpoint if t.endpoint.available() else self.bridges.choose()
+            sid = self._newId(ep)
+            self.client.create(ep, sid)
+            t.replace(ep, sid)
+            for key in keys:
+                self.index.put(key, ep.name, sid, t.timestamp)
+            self.rotated += 1
+
+    def rotate(self, margin: float) -> int:
+        """
+        在后台轮换`margin`秒内就会到期的会话，用户的请求不必付出续期的往返。
+        对话链总在同一个chat中，一个会话的所有key都在同一个分片的同一项里。
+        返回成功轮换的会话数。
+        """
+        deadline = time.time() - (session_lifetime - margin)
+        due = [(t, keys) for shard in self.shards for t, keys in self._snapshot(shard)
+               if t.timestamp < deadline]
+        rotated = 0
+        for t, keys in due:
+            try:
+                self._rotate(t, keys)
+            except GptBridgeException:
+                self.rotatefailures += 1
+                continue
+            rotated += 1
+        return rotated
+
+    async def aask(self, t: OpenAICallingProxy, content: str) -> str:
+        try:
+            return await t.acall(content)
         except GptTokenExpireException:
-            self.bot.debuginfo("token expired, renewing...")
-            t.update(self._newId())
-            return t.call(content)
-
-    def ensure_id_call(self, msg: botmessages, content: str):
-        with self.lock:
-            if msg not in self.sessions:
-                raise Exception("session not found")
-            t = self.sessions[msg]
+            await self.loop.run_blocking(self._renew, t)
+            return await t.acall(content)
+
+    async def astream(self, t: OpenAICallingProxy, content: str) -> AsyncIterator[str]:
+        """和`aask`一样，会话快到期时先续期，再开始流式读取"""
         try:
-            return t.call(content)
+            return t.astream(content)
         except GptTokenExpireException:
-            self.bot.debuginfo("token expired, renewing...")
-            t.update(self._newId())
-            return t.call(content)
+            await self.loop.run_blocking(self._renew, t)
+            return t.astream(content)
+
+    def submit(
+        self,
+        msg: botmessages,
+        content: str,
+        handler: Callable[[OpenAICallingProxy, str], Awaitable[Any]],
+        onerror: Callable[[Exception], Any],
+        ensure_id=False,
+        priority=False,
+        user=0,
+        tag: Optional[str] = None,
+    ) -> None:
+        """
+        把请求放进会话的FIFO队列后立即返回，请求在gpt事件循环中处理。
+        每个会话同一时刻最多只有一个消费者协程在处理队列，
+        调用bridge前还要经过`admissionScheduler`的准入控制，
+        没有拿到名额时`onerror`会收到`GptBusyException`.
+        给出`tag`时，请求可以通过`cancel`取消。
+        会话查找失败的异常仍然在这里同步抛出。
+        """
+        t = self._session(msg, not ensure_id)
+        self.loop.call_soon(self._enqueue, t, gptRequest(
+            msg.chat, priority, content, handler, onerror, user, tag))
+
+    def submit_cached(
+        self,
+        msg: botmessages,
+        content: str,
+        handler: Callable[[OpenAICallingProxy, str], Awaitable[str]],
+        deliver: Callable[[str, bool], Any],
+        onerror: Callable[[Exception], Any],
+        priority=False,
+        fresh=False,
+        user=0,
+        tag: Optional[str] = None,
+    ) -> None:
+        """
+        第一轮提问（新会话）走回答缓存。`handler`需要返回回答文本。
+        命中缓存或等到相同问题的结果时，不创建bridge会话，由`deliver(回答, 是否为近似匹配)`
+        在sender线程中发送回答；否则和`submit`一样创建会话并排队，结果写入缓存。
+        `fresh`为True时不查缓存，但结果仍然写入缓存。
+        缓存的回答没有对应的会话，`deliver`需要用`bind_cached`登记发出的消息，才能继续追问。
+        """
+        key = self.cache.normalize(content)
+        self.loop.call_soon(self._lookup, msg, key, content, handler, deliver, onerror,
+                            gptRequest(msg.chat, priority, content, None, None, user, tag), fresh)
+
+    def _lookup(self, msg: botmessages, key: str, content: str,
+                handler: Callable[[OpenAICallingProxy, str], Awaitable[str]],
+                deliver: Callable[[str, bool], Any], onerror: Callable[[Exception], Any],
+                request: gptRequest, fresh: bool) -> None:
+        if not fresh:
+            answer = self.cache.get(key)
+            if answer is not None:
+                self.loop.senders.submit(deliver, answer, False)
+                return
+            answer = self.cache.nearest(key)
+            if answer is not None:
+                self.loop.senders.submit(deliver, answer, True)
+                return
+        future = self.cache.begin(key)
+        if future is not None:
+            self.loop.loop.create_task(self._share(future, deliver, onerror))
+            return
+        self.loop.loop.create_task(self._fill(
+            msg, key, handler, onerror, request))
+
+    async def _share(self, future: asyncio.Future, deliver: Callable[[str, bool], Any],
+                     onerror: Callable[[Exception], Any]) -> None:
+        try:
+            answer = await asyncio.wait_for(self.cache.wait(future), gpt_share_timeout)
+        except asyncio.TimeoutError:
+            self.loop.senders.submit(onerror, GptBusyException())
+            return
+        except Exception as e:
+            self.loop.senders.submit(onerror, e)
+            return
+        self.loop.senders.submit(deliver, answer, False)
+
+    async def _fill(self, msg: botmessages, key: str,
+                    handler: Callable[[OpenAICallingProxy, str], Awaitable[str]],
+                    onerror: Callable[[Exception], Any], request: gptRequest) -> None:
+        settled = False
+
+        def settle(answer: Optional[str], cost: float, e: Optional[Exception]) -> None:
+            """只结束一次缓存项：之后同一个key可能已经有新的请求在填充"""
+            nonlocal settled
+            if settled:
+                return
+            settled = True
+            if e is None:
+                self.cache.put(key, answer, cost)
+            else:
+                self.cache.fail(key, e)
+
+        def failed(e: Exception):
+            self.loop.call_soon(settle, None, 0.0, e)
+            onerror(e)
+
+        async def caching(t: OpenAICallingProxy, content: str) -> str:
+            start = time.monotonic()
+            try:
+                answer = await handler(t, content)
+            except asyncio.CancelledError as e:
+                settle(None, 0.0, GptCancelledException())
+                raise e
+            if request.cancelled:
+                # 被取消的流式回答只有一部分，不能放进缓存
+                settle(None, 0.0, GptCancelledException())
+            else:
+                settle(answer, time.monotonic() - start, None)
+            return answer
+
+        request.handler = caching
+        request.onerror = failed
+        # 在等待会话、排队或准入时被取消，等待相同问题的人不能一直等下去
+        request.oncancel = lambda: settle(None, 0.0, GptCancelledException())
+        if request.tag is not None:
+            self.active[request.tag] = request
+        try:
+            t = await self.loop.run_blocking(self._session, msg, True)
+        except Exception as e:
+            self._finish([request])
+            self.loop.senders.submit(failed, e)
+            return
+        self._enqueue(t, request)
 
-    def _newId(self) -> int:
-        response = requests.get(f"http://127.0.0.1:{openai_port}/newid")
-        if response.status_code == 200:
-            return int(response.text)
-        raise Exception("OpenAI API error")
+    def _enqueue(self, t: OpenAICallingProxy, request: gptRequest) -> None:
+        if request.cancelled:
+            return
+        if request.tag is not None:
+            self.active[request.tag] = request
+        t.queue.append(request)
+        self.submitted += 1
+        if not t.draining:
+            t.draining = True
+            self.loop.loop.create_task(self._drain(t))
+
+    async def _drain(self, t: OpenAICallingProxy) -> None:
+        """
+        会话队列的唯一消费者。开启`debounce`时，等到队首请求到达后`debounce`秒，
+        把期间到达的所有请求合并成一次bridge调用，由最后一个请求的handler回复。
+        """
+        self.inflight += 1
+        try:
+            while t.queue:
+                if gpt_debounce > 0:
+                    wait = t.queue[0].arrival + gpt_debounce - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                batch = [r for r in t.queue if not r.cancelled]
+                t.queue.clear()
+                if not batch:
+                    continue
+                last = batch[-1]
+                self.merged += len(batch) - 1
+                try:
+                    await self.scheduler.acquire(last.chat, last.priority)
+                except GptBusyException as e:
+                    self._finish(batch)
+                    self.loop.senders.submit(last.onerror, e)
+                    continue
+                try:
+                    if all(r.cancelled for r in batch):
+                        continue
+                    content = "\n".join(r.content for r in batch)
+                    if t.prelude is not None:
+                        content = t.prelude + content
+                    # handler放在单独的task中运行，取消请求时只取消这个task
+                    task = self.loop.loop.create_task(last.handler(t, content))
+                    for r in batch:
+                        r.task = task
+                    await task
+                    t.prelude = None
+                except asyncio.CancelledError as e:
+                    if not any(r.cancelled for r in batch):
+                        raise e
+                except Exception as e:
+                    self.loop.senders.submit(last.onerror, e)
+                finally:
+                    self.scheduler.release()
+                    self._finish(batch)
+        finally:
+            t.draining = False
+            self.inflight -= 1
+
+    def _finish(self, batch: List[gptRequest]) -> None:
+        for r in batch:
+            if r.tag is not None and self.active.get(r.tag) is r:
+                del self.active[r.tag]
+
+    def cancel(self, chat: int, user: Optional[int] = None, tag: Optional[str] = None) -> int:
+        """
+        取消`chat`中`user`的所有请求（`user`为None时不限用户），给出`tag`时只取消这一个请求。
+        排队中的请求直接丢弃并调用其`oncancel`，正在调用bridge的请求取消其task，bridge连接随之关闭。
+        可以从任意线程调用，返回取消的请求数。
+        """
+        return self.loop.spawn(self._cancel(chat, user, tag)).result()
+
+    async def _cancel(self, chat: int, user: Optional[int], tag: Optional[str]) -> int:
+        if tag is not None:
+            candidates = [self.active[tag]] if tag in self.active else []
+        else:
+            candidates = list(self.active.values())
+        n = 0
+        for r in candidates:
+            if r.chat != chat or (user is not None and r.user != user):
+                continue
+            r.cancelled = True
+            del self.active[r.tag]
+            if r.task is None:
+                if r.oncancel is not None:
+                    r.oncancel()
+            elif not r.task.done():
+                r.task.cancel()
+            n += 1
+        self.cancelled += n
+        return n
+
+    def _newId(self, ep: bridgeEndpoint) -> int:
+        return self.client.newid(ep)
+
+    def _provision(self) -> Tuple[bridgeEndpoint, int, float]:
+        ep = self.bridges.choose()
+        sid = self._newId(ep)
+        self.client.create(ep, sid)
+        return ep, sid, time.time()
+
+    @staticmethod
+    def _stale(pooled: Tuple[bridgeEndpoint, int, float]) -> bool:
+        """池中放得太久、取出后轮换任务马上就要换掉的id不再使用"""
+        return time.time() - pooled[2] > session_lifetime - 2 * session_rotate_interval
+
+    def _notify(self, text: str) -> None:
+        if self.bot is None:
+            return
+        self.bot.reply_nowait(MYID, text)
+
+    def _breakerwatcher(self, ep: bridgeEndpoint) -> Callable[[str, str], None]:
+        def onchange(old: str, new: str) -> None:
+            """只在bridge刚刚不可用和恢复时通知主人，half-open期间的反复切换不通知"""
+            if new == circuitBreaker.OPEN and old == circuitBreaker.CLOSED:
+                self._notify(f"GPT bridge {ep.name} 连续出错，已暂停调用")
+            elif new == circuitBreaker.CLOSED:
+                self._notify(f"GPT bridge {ep.name} 已恢复")
+        return onchange
+
+    def _onhealthchange(self, ep: bridgeEndpoint) -> None:
+        if ep.healthy:
+            self._notify(f"GPT bridge {ep.name} 健康检查恢复")
+        else:
+            self._notify(f"GPT bridge {ep.name} 无法连接，不再分配新会话")
 
     def register_session(self, botmsg: botmessages, nextbotmsg: botmessages):
-        with self.lock:
-            if botmsg not in self.sessions:
-                raise Exception("session not found")
-            self.sessions[nextbotmsg] = self.sessions[botmsg]
+        # 回答和提问在同一个chat中，因此在同一个分片里
+        shard = self._shard(botmsg)
+        with shard.lock:
+            t = shard.sessions.alias(botmsg, nextbotmsg)
+        self.index.put(nextbotmsg, t.endpoint.name, t.sid, t.timestamp)
+
+    def stats(self) -> Dict[str, int]:
+        ans: Dict[str, int] = {}
+        for shard in self.shards:
+            with shard.lock:
+                for k, v in shard.sessions.stats().items():
+                    ans[k] = ans.get(k, 0) + v
+        ans["submitted"] = self.submitted
+        ans["merged"] = self.merged
+        ans["inflight"] = self.inflight
+        ans["cancelled"] = self.cancelled
+        ans["sessions_rotated"] = self.rotated
+        ans["rotate_failures"] = self.rotatefailures
+        ans.update(self.scheduler.stats())
+        ans.update(self.cache.stats())
+        ans.update(self.bridges.stats())
+        ans.update(self.index.stats())
+        ans.update(self.pool.stats())
+        ans.update(self.client.stats())
+        ans.update(self.aclient.stats())
+        return ans
+
+    def close(self):
+        self.pool.close()
+        self.bridges.close()
+        self.loop.call_soon(self.aclient.close)
+        self.loop.stop()
+        self.index.close()
 
 
 keeper = OpenAISessionKeeper()
@@ -106,22 +616,199 @@ class gptBot(baseBot):
         print("gpt bot init finish")
         self.gpt_session_keeper = keeper
         keeper.bot = self
+        keeper.client = OpenAIBridgeClient(
+            self.updater.dispatcher.workers, keeper.bridges)
+        keeper.bridges.start(health_interval)
+        keeper.pool.start()
+        keeper.loop.start()
+        self.updater.job_queue.run_repeating(
+            self.rotate_sessions, interval=session_rotate_interval,
+            first=session_rotate_interval, name="gpt_session_rotate")
         self.gpt_allow_database = GPTPermissionDatabase(self, gpt_database)
         allow_data_all = self.gpt_allow_database.select("GPT")
         self.gpt_allow_list = set(r[0] for r in allow_data_all)
 
-    def call_gpt(self, botmsg: botmessages, content: str, ensure_id=False):
-        if ensure_id:
-            return self.gpt_session_keeper.ensure_id_call(botmsg, content)
-        return self.gpt_session_keeper.call(botmsg, content)
+    def ask_gpt(self, update: Update, botmsg: botmessages, content: str, ensure_id=False, fresh=False) -> None:
+        """
+        把问题放进会话的请求队列后立即返回。
+        回答由gpt事件循环发送，并把回答消息注册到`botmsg`所在的会话中。
+        `fresh`为True时不使用缓存的回答。
+        """
+        # 用户的提问消息标识这个请求，/cancel和停止按钮都按它取消
+        tag = f"{self.lastchat}:{self.lastmsgid}"
+
+        async def handler(t: OpenAICallingProxy, content: str) -> str:
+            if openai_stream:
+                parts: List[str] = []
+
+                async def collect(pieces: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+                    try:
+                        async for piece in pieces:
+                            parts.append(piece)
+                            yield piece
+                    finally:
+                        await pieces.aclose()
+
+                pieces = await self.gpt_session_keeper.astream(t, content)
+                msgid = await self.replyStream(
+                    collect(pieces), GPT_STOP_PREFIX + tag)
+                answer = "".join(parts)
+            else:
+                answer = await self.gpt_session_keeper.aask(t, content)
+                msgid = await asyncio.wrap_future(self.reply_answer(answer))
+            self.register_sessionid(botmsg, botmessages(self.lastchat, msgid))
+            return answer
+
+        def onerror(e: Exception):
+            if isinstance(e, GptBusyException):
+                self.reply_nowait("现在提问的人太多了，请稍后再试")
+                return
+            if isinstance(e, GptCancelledException):
+                self.reply_nowait("相同问题的回答被提问者停止了，请重新提问")
+                return
+            if isinstance(e, GptBridgeException):
+                # bridge的故障由熔断器统一通知主人，这里只回复用户
+                self.debuginfo(f"bridge error: {e}")
+                self.reply_nowait(GPT_UNAVAILABLE)
+                return
+            self.updater.dispatcher.dispatch_error(update, e)
+
+        priority = self.lastuser == MYID
+        if not ensure_id and self.gpt_session_keeper.cache.enabled():
+            def deliver(answer: str, similar: bool):
+                if not similar:
+                    future = self.reply_answer(answer)
+                else:
+                    # 近似匹配的回答可能答非所问，附上按钮让提问者要求重新回答
+                    key = f"{GPT_FRESH_PREFIX}{botmsg.chat}:{botmsg.msgid}"
+                    self.callbackDataServer.setData(key, content)
+                    future = self.reply_answer(answer, InlineKeyboardMarkup(
+                        [[InlineKeyboardButton("重新回答", callback_data=key)]]))
+
+                def bind(future: Future):
+                    if not future.cancelled() and future.exception() is None:
+                        self.gpt_session_keeper.bind_cached(
+                            botmessages(botmsg.chat, future.result()), content, answer)
+
+                # 不在线程中等待发送完成，发出后再登记
+                future.add_done_callback(bind)
+                self._nowait(future, SEND_INTERACTIVE)
+
+            self.gpt_session_keeper.submit_cached(
+                botmsg, content, handler, deliver, onerror, priority, fresh,
+                self.lastuser, tag)
+            return
+        self.gpt_session_keeper.submit(
+            botmsg, content, handler, onerror, ensure_id, priority,
+            self.lastuser, tag)
+
+    def reply_answer(self, answer: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> Future:
+        """发送完整的回答，开启`gpt_paginate`时分页发送。返回message id的future"""
+        if gpt_paginate:
+            return self.replyPagedFuture(answer, reply_markup)
+        return self.reply_future(answer, reply_markup=reply_markup)
+
+    async def _edit_stream_message(
+        self, chat: int, msgid: int, text: str,
+        markup: Optional[InlineKeyboardMarkup] = None,
+    ) -> None:
+        """
+        通过发送队列编辑流式回答的消息，等到编辑完成。限流时由发送队列等待后重试。
+        不给`markup`时消息上的按钮会被去掉。
+        """
+        await asyncio.wrap_future(self.sender.send([{
+            "chat_id": chat,
+            "message_id": msgid,
+            "text": text,
+            "reply_markup": markup,
+        }], "edit_message_text"))
+
+    async def replyStream(self, pieces: AsyncGenerator[str, None], stopkey: Optional[str] = None) -> int:
+        """
+        先发送一条占位消息，再把`pieces`中陆续到来的文本合并成限频的
+        `edit_message_text`调用。文本超过单条消息长度上限时，另起一条新消息继续编辑。
+        给出`stopkey`时，回答完成前消息上带一个停止按钮。
+        请求被取消时保留已经收到的部分，正常返回。
+        在gpt事件循环中运行，所有消息都经过发送队列，等待时不占用线程。返回最后一条消息的message id.
+        """
+        chat = self.lastchat
+        interval = stream_edit_interval if chat > 0 else stream_group_edit_interval
+        markup = None
+        if stopkey is not None:
+            markup = InlineKeyboardMarkup(
+                [[InlineKeyboardButton("停止", callback_data=stopkey)]])
+        msgid = await asyncio.wrap_future(self.reply_future("……", reply_markup=markup))
+        text = ""
+        shown = ""
+        lastedit = 0.0
+        try:
+            async for piece in pieces:
+                text += piece
+                while len(text) > MAX_MESSAGE_LENGTH:
+                    await self._edit_stream_message(chat, msgid, text[:MAX_MESSAGE_LENGTH])
+                    text = text[MAX_MESSAGE_LENGTH:]
+                    msgid = await asyncio.wrap_future(self.sender.send([{
+                        "chat_id": chat,
+                        "text": "……",
+                        "reply_to_message_id": msgid,
+                        "reply_markup": markup,
+                    }]))
+                    shown = ""
+                now = time.monotonic()
+                if now - lastedit >= interval and text != shown and text.strip():
+                    await self._edit_stream_message(chat, msgid, text, markup)
+                    shown = text
+                    lastedit = now
+        except asyncio.CancelledError:
+            # 立即关闭bridge连接，不必等垃圾回收
+            await pieces.aclose()
+            try:
+                await self._edit_stream_message(
+                    chat, msgid, (text[:MAX_MESSAGE_LENGTH - 8] + "\n（已停止）").strip())
+            except Exception:
+                ...
+            return msgid
+        except Exception as e:
+            try:
+                await self._edit_stream_message(
+                    chat, msgid, text[:MAX_MESSAGE_LENGTH - 8] + "\n（回答中断）")
+            except Exception:
+                ...
+            raise e
+        if text != shown and text.strip():
+            await self._edit_stream_message(chat, msgid, text)
+        elif markup is not None:
+            # 文本没有变化或回答为空时编辑文本会失败，只去掉停止按钮
+            await asyncio.wrap_future(self.sender.send([{
+                "chat_id": chat,
+                "message_id": msgid,
+                "reply_markup": None,
+            }], "edit_message_reply_markup"))
+        return msgid
+
+    def rotate_sessions(self, context: CallbackContext) -> None:
+        # 下一次运行之前就会到期的会话都在这一轮换掉
+        rotated = self.gpt_session_keeper.rotate(2 * session_rotate_interval)
+        if rotated:
+            self.debuginfo(f"{rotated} gpt sessions rotated")
 
     def register_sessionid(self, botmsg: botmessages, nextbotmsg: botmessages):
         self.gpt_session_keeper.register_session(botmsg, nextbotmsg)
 
     def addPermmision(self, chatid: int):
+        """内存中的名单立即生效，数据库由后台写线程写入"""
         if chatid not in self.gpt_allow_list:
             self.gpt_allow_list.add(chatid)
-            self.gpt_allow_database.insertInto("GPT", {"TGID": chatid})
+            self.gpt_allow_database.insertLater("GPT", {"TGID": chatid})
+
+    def addPermmisions(self, chatids: List[int]) -> int:
+        """批量开启权限，和`addPermmision`一样内存中立即生效，返回新开启的数量"""
+        new = [x for x in dict.fromkeys(chatids) if x not in self.gpt_allow_list]
+        if new:
+            self.gpt_allow_list.update(new)
+            self.gpt_allow_database.upsertManyLater(
+                "GPT", [{"TGID": x} for x in new])
+        return len(new)
 
     @staticmethod
     def processMessage(text: str) -> str:
@@ -137,9 +824,21 @@ class gptBot(baseBot):
         oldmsg = botmessages(
             self.lastchat, self.lastmsgid)
         question = self.processMessage(update.message.text)
-        msgid = self.reply(self.call_gpt(oldmsg, question))
-        self.gpt_session_keeper.register_session(oldmsg, botmessages(
-            self.lastchat, msgid))
+        try:
+            self.ask_gpt(update, oldmsg, question)
+        except GptBridgeException as e:
+            # 池中没有预先创建的id时，在熔断器打开之前创建会话也可能失败
+            self.debuginfo(f"bridge error: {e}")
+            return self.errorInfo(GPT_UNAVAILABLE)
+        return True
+
+    @commandCallbackMethod
+    def gptstats(self, update: Update, context: CallbackContext) -> handleStatus:
+        if not isfromme(update):
+            return self.errorInfo("你没有权限")
+        stats = self.gpt_session_keeper.stats()
+        stats.update(self.sender.stats())
+        self.reply_nowait("\n".join(f"{k}: {v}" for k, v in stats.items()))
         return True
 
     @commandCallbackMethod
@@ -148,14 +847,19 @@ class gptBot(baseBot):
             return self.errorInfo("你没有权限")
         if isprivate(update):
             try:
-                allowId = int(context.args[0])
+                allowIds = [int(x) for x in context.args]
             except Exception:
-                return self.errorInfo("用法: /allowgpt <群号>")
-            self.addPermmision(allowId)
-            self.reply("已开启")
+                allowIds = []
+            if not allowIds:
+                return self.errorInfo("用法: /allowgpt <群号> [群号...]")
+            if len(allowIds) == 1:
+                self.addPermmision(allowIds[0])
+                self.reply_nowait("已开启")
+            else:
+                self.reply_nowait(f"已开启{self.addPermmisions(allowIds)}个")
         else:
             self.addPermmision(self.lastchat)
-            self.reply("已开启")
+            self.reply_nowait("已开启")
         return True
 
     def textHandler(self, update: Update, context: CallbackContext) -> handleStatus:
@@ -166,17 +870,55 @@ class gptBot(baseBot):
         oldmsg = botmessages(self.lastchat,
                              update.message.reply_to_message.message_id)
         try:
-            msgid = self.reply(self.call_gpt(
-                oldmsg, update.message.text, ensure_id=True))
-        except Exception:
+            self.ask_gpt(update, oldmsg, update.message.text, ensure_id=True)
+        except GptSessionExpiredException:
+            self.reply_nowait("这个对话已经过期了，请使用 /gpt 开始新的对话")
+            return handleBlocked()
+        except GptBridgeException as e:
+            self.debuginfo(f"bridge error: {e}")
+            self.reply_nowait(GPT_UNAVAILABLE)
+            return handleBlocked()
+        except GptSessionNotFoundException:
             self.debuginfo("no session, ignored")
             return handlePassed
-        self.gpt_session_keeper.register_session(
-            oldmsg,
-            botmessages(self.lastchat, msgid)
-        )
         return handleBlocked()
 
+    @commandCallbackMethod
+    def cancel(self, update: Update, context: CallbackContext) -> None:
+        if self.gpt_session_keeper.cancel(self.lastchat, self.lastuser):
+            self.reply_nowait("已停止回答")
+            return
+        baseBot.__dict__["cancel"].__wrapped__(self, update, context)
+
+    def buttonHandler(self, update: Update, context: CallbackContext) -> handleStatus:
+        query = update.callback_query
+        if query.data.startswith(GPT_STOP_PREFIX):
+            # 只有提问者和主人可以停止回答
+            user = None if self.lastuser == MYID else self.lastuser
+            self.gpt_session_keeper.cancel(
+                self.lastchat, user, query.data[len(GPT_STOP_PREFIX):])
+            return handleBlocked()
+        if not query.data.startswith(GPT_FRESH_PREFIX):
+            return baseBot.buttonHandler(self, update, context)
+        try:
+            question = self.callbackDataServer.getData(query.data)
+        except ValueError:
+            return handleBlocked(self.queryError(query))
+        query.edit_message_reply_markup(reply_markup=None)
+        # 新的回答回复缓存的那条回答，并以它开始一个新会话
+        self.lastmsgid = query.message.message_id
+        botmsg = botmessages(self.lastchat, query.message.message_id)
+        try:
+            self.ask_gpt(update, botmsg, question, fresh=True)
+        except GptBridgeException as e:
+            self.debuginfo(f"bridge error: {e}")
+            return handleBlocked(self.errorInfo(GPT_UNAVAILABLE))
+        return handleBlocked()
+
+    def beforestop(self):
+        self.gpt_session_keeper.close()
+        self.gpt_allow_database.close()
+
     @classmethod
     def chatmigrate(cls, oldchat: int, newchat: int, instance: "gptBot"):
         if oldchat in instance.gpt_allow_list:
@@ -185,9 +927,9 @@ class gptBot(baseBot):
             )
             instance.gpt_allow_list.remove(oldchat)
             instance.gpt_allow_list.add(newchat)
-            instance.gpt_allow_database.delete(
+            instance.gpt_allow_database.deleteLater(
                 "GPT", {"TGID": oldchat}
             )
-            instance.gpt_allow_database.insertInto(
+            instance.gpt_allow_database.insertLater(
                 "GPT", {"TGID": newchat}
             )
@@ -0,0 +1,243 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class similarityIndex(object):
+    """
+    近似重复问题的MinHash/LSH索引。
+    问题去掉标点后按字符n-gram切分，用`PERMS`个哈希函数计算MinHash签名，
+    签名分成`BANDS`段，每段哈希成一个LSH桶号。查询时只和至少有一个桶号相同的候选比较签名，
+    估计的Jaccard相似度不低于`threshold`即命中。
+
+    全部数据放在预先分配的numpy数组里，最多`capacity`条，写满后覆盖最早的记录。
+    桶号不用dict保存，而是排好序的一维数组，查询时用`searchsorted`一次查完所有段；
+    上次排序之后新写入的记录的桶号放在小的dict `recent`中，攒够一批再重新排序。
+    """
+    PERMS = 64
+    BANDS = 16
+    SHINGLE = 3
+    PRIME = 4294967291  # 小于2**32的最大素数，签名可以存成uint32
+
+    def __init__(self, capacity: int, threshold: float, ttl: float, seed: int = 0x67707431) -> None:
+        rng = np.random.default_rng(seed)
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self.a = rng.integers(1, self.PRIME, self.PERMS, dtype=np.uint64)
+        self.b = rng.integers(0, self.PRIME, self.PERMS, dtype=np.uint64)
+        rows = self.PERMS // self.BANDS
+        self.bandmul = rng.integers(
+            1, 2**63, rows, dtype=np.uint64) | np.uint64(1)
+        # 每段加上不同的盐，所有段的桶号可以放在同一个数组里排序
+        self.bandsalt = rng.integers(0, 2**63, self.BANDS, dtype=np.uint64)
+        self.signatures = np.zeros((capacity, self.PERMS), dtype=np.uint32)
+        self.bandkeys = np.zeros((capacity, self.BANDS), dtype=np.uint64)
+        self.sortedkeys = np.zeros(0, dtype=np.uint64)
+        self.sortedslots = np.zeros(0, dtype=np.int32)
+        self.recent: Dict[int, List[int]] = {}
+        self.pending = 0
+        self.rebuildevery = max(256, capacity // 64)
+        # slot -> (回答, bridge耗时, 写入时间)
+        self.values: List[Optional[Tuple[str, float, float]]] = [
+            None] * capacity
+        self.next = 0
+        self.size = 0
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return " ".join(re.sub(r"[\W_]+", " ", text.casefold()).split())
+
+    def _signature(self, text: str) -> Tuple["np.ndarray", "np.ndarray"]:
+        codes = np.frombuffer(self._normalize(text).encode(
+            "utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        n = self.SHINGLE
+        if len(codes) < n:
+            codes = np.concatenate(
+                [codes, np.zeros(n - len(codes), dtype=np.uint64)])
+        # n-gram的码点组合成一个整数，再乘一个奇数常量后取高32位作为shingle哈希
+        h = codes[:len(codes) - n + 1].copy()
+        for i in range(1, n):
+            h = h * np.uint64(0x110000) + codes[i:len(codes) - n + 1 + i]
+        h = np.unique((h * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32))
+        sig = ((self.a[:, None] * h[None, :] + self.b[:, None]) %
+               np.uint64(self.PRIME)).min(axis=1)
+        keys = (sig.reshape(self.BANDS, -1) *
+                self.bandmul).sum(axis=1) ^ self.bandsalt
+        return sig.astype(np.uint32), keys
+
+    def _candidates(self, keys: "np.ndarray") -> "np.ndarray":
+        lo = np.searchsorted(self.sortedkeys, keys, "left")
+        hi = np.searchsorted(self.sortedkeys, keys, "right")
+        parts = [self.sortedslots[l:h]
+                 for l, h in zip(lo.tolist(), hi.tolist()) if h > l]
+        if self.recent:
+            for key in keys.tolist():
+                slots = self.recent.get(key)
+                if slots:
+                    parts.append(np.array(slots, dtype=np.int32))
+        if not parts:
+            return self.sortedslots[:0]
+        if len(parts) == 1:
+            return parts[0]
+        return np.unique(np.concatenate(parts))
+
+    def find(self, text: str) -> Optional[Tuple[str, float]]:
+        """返回最相似且未过期的记录的`(回答, bridge耗时)`，没有足够相似的记录时返回None"""
+        sig, keys = self._signature(text)
+        slots = self._candidates(keys)
+        if len(slots) == 0:
+            return None
+        # 排序后被覆盖的slot也可能出现在候选中，但比较的是它当前的签名，结果仍然正确
+        sims = (self.signatures[slots] == sig).mean(axis=1)
+        best = int(sims.argmax())
+        if sims[best] < self.threshold:
+            return None
+        value = self.values[slots[best]]
+        if value is None or time.monotonic() - value[2] > self.ttl:
+            return None
+        return value[0], value[1]
+
+    def add(self, text: str, answer: str, cost: float) -> None:
+        sig, keys = self._signature(text)
+        slot = self.next
+        self.next = (self.next + 1) % self.capacity
+        if self.values[slot] is None:
+            self.size += 1
+        self.signatures[slot] = sig
+        self.bandkeys[slot] = keys
+        self.values[slot] = (answer, cost, time.monotonic())
+        for key in keys.tolist():
+            self.recent.setdefault(key, []).append(slot)
+        self.pending += 1
+        if self.pending >= self.rebuildevery:
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        # 环形写入时前`size`个slot都已被占用
+        keys = self.bandkeys[:self.size].ravel()
+        order = np.argsort(keys)
+        self.sortedkeys = keys[order]
+        self.sortedslots = (order // self.BANDS).astype(np.int32)
+        self.recent = {}
+        self.pending = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class responseCache(object):
+    """
+    无状态第一轮提问的回答缓存，key是规范化后的问题文本。
+    按LRU和TTL淘汰，最多保留`maxentries`条。
+    同一个问题正在向bridge请求时，后来的相同问题通过`inflight`中的future等待同一个结果。
+    提供`similar`时，精确匹配不到的问题再到近似重复索引中查找。
+
+    只能在gpt事件循环中使用。
+    """
+
+    def __init__(self, maxentries: int, ttl: float, similar: Optional[similarityIndex] = None) -> None:
+        self.maxentries = maxentries
+        self.ttl = ttl
+        self.similar = similar
+        # key -> (回答, bridge耗时, 写入时间)
+        self.entries: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.shared = 0
+        self.similarhits = 0
+        self.similarlookups = 0
+        self.similartime = 0.0
+        self.saved = 0.0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split()).casefold()
+
+    def enabled(self) -> bool:
+        return self.maxentries > 0
+
+    def get(self, key: str) -> Optional[str]:
+        self.lookups += 1
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        answer, cost, stored = entry
+        if time.monotonic() - stored > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.saved += cost
+        return answer
+
+    def nearest(self, key: str) -> Optional[str]:
+        """在近似重复索引中查找，应在`get`没有命中之后调用"""
+        if self.similar is None:
+            return None
+        start = time.perf_counter()
+        found = self.similar.find(key)
+        self.similartime += time.perf_counter() - start
+        self.similarlookups += 1
+        if found is None:
+            return None
+        self.similarhits += 1
+        self.saved += found[1]
+        return found[0]
+
+    def begin(self, key: str) -> Optional[asyncio.Future]:
+        """
+        开始向bridge请求`key`。返回None表示调用者负责请求并在结束时调用`put`或`fail`；
+        已经有相同的请求在进行时，返回它的future.
+        """
+        future = self.inflight.get(key)
+        if future is not None:
+            self.shared += 1
+            return future
+        self.inflight[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def put(self, key: str, answer: str, cost: float) -> None:
+        self.entries[key] = (answer, cost, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxentries:
+            self.entries.popitem(last=False)
+        if self.similar is not None:
+            self.similar.add(key, answer, cost)
+        future = self.inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result((answer, cost))
+
+    def fail(self, key: str, e: BaseException) -> None:
+        future = self.inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_exception(e)
+            # 没有人在等待时不要打印"exception was never retrieved"
+            future.exception()
+
+    async def wait(self, future: asyncio.Future) -> str:
+        answer, cost = await asyncio.shield(future)
+        self.saved += cost
+        return answer
+
+    def stats(self) -> Dict[str, float]:
+        served = self.hits + self.shared + self.similarhits
+        ans = {
+            "cache_entries": len(self.entries),
+            "cache_lookups": self.lookups,
+            "cache_hits": self.hits,
+            "cache_shared": self.shared,
+            "cache_hit_rate": round(served / self.lookups, 3) if self.lookups else 0.0,
+            "cache_saved_seconds": round(self.saved, 1),
+        }
+        if self.similar is not None:
+            ans["similar_entries"] = len(self.similar)
+            ans["similar_hits"] = self.similarhits
+            ans["similar_lookup_us"] = round(
+                self.similartime / self.similarlookups * 1e6, 1) if self.similarlookups else 0.0
+        return ans
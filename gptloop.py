@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (Any, Awaitable, Callable, Deque, Dict, List, Optional,
+                    Tuple, TypeVar)
+
+_RT = TypeVar("_RT")
+
+
+class gptEventLoop(object):
+    """
+    GPT请求专用的asyncio事件循环，运行在独立线程中。
+    bridge调用全部在这个循环里以协程方式进行，同时进行的对话数不受线程数限制；
+    Telegram的发送接口是同步的，交给一个小的sender线程池执行。
+    """
+
+    def __init__(self, senders: int) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.senders = ThreadPoolExecutor(
+            senders, thread_name_prefix="gpt-sender")
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self._run, name="gpt-loop", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call_soon(self, func: Callable[..., Any], *args) -> None:
+        """在事件循环线程中执行`func`，可以从任意线程调用"""
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def spawn(self, coro: Awaitable[_RT]) -> "Future[_RT]":
+        """从任意线程提交一个协程，返回`concurrent.futures.Future`"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_blocking(self, func: Callable[..., _RT], *args, **kwargs) -> _RT:
+        """在sender线程池中执行同步函数，例如Telegram的发送接口"""
+        return await self.loop.run_in_executor(
+            self.senders, functools.partial(func, *args, **kwargs)
+        )
+
+    def stop(self, timeout: float = 10) -> None:
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        self.senders.shutdown(wait=True)
+        self.thread = None
+
+
+class GptBusyException(Exception):
+    ...
+
+
+class _ticket(object):
+    __slots__ = ["chat", "future", "enqueued", "cancelled"]
+
+    def __init__(self, chat: int, future: asyncio.Future) -> None:
+        self.chat = chat
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+
+
+class admissionScheduler(object):
+    """
+    bridge调用的准入控制，只能在gpt事件循环中使用。
+
+    同时运行的请求数不超过`concurrency`。超出的请求按chat做加权公平排队
+    （self-clocked fair queuing）：每个chat的请求依次获得虚拟完成时间
+    `max(当前虚拟时间, 该chat上一个请求的完成时间) + 1/权重`，按完成时间从小到大放行，
+    一个繁忙的群不会饿死其他群。排队数达到`maxqueue`时直接抛出`GptBusyException`.
+    主人的请求走优先通道，总是先于普通队列放行，也不受排队上限限制。
+    """
+
+    def __init__(self, concurrency: int, maxqueue: int, weights: Dict[int, float]) -> None:
+        self.concurrency = concurrency
+        self.maxqueue = maxqueue
+        self.weights = weights
+        self.running = 0
+        self.waiting = 0
+        self.vtime = 0.0
+        self.finish: Dict[int, float] = {}
+        self.heap: List[Tuple[float, int, _ticket]] = []
+        self.priority: Deque[_ticket] = deque()
+        self.seq = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+        self.waits: Deque[float] = deque(maxlen=1024)
+
+    async def acquire(self, chat: int, priority: bool = False) -> None:
+        if self.running < self.concurrency and self.waiting == 0:
+            self.running += 1
+            self._admit(0.0)
+            return
+        if not priority and self.waiting >= self.maxqueue:
+            self.rejected += 1
+            raise GptBusyException("bridge busy")
+
+        t = _ticket(chat, asyncio.get_running_loop().create_future())
+        if priority:
+            self.priority.append(t)
+        else:
+            start = max(self.vtime, self.finish.get(chat, 0.0))
+            f = start + 1.0 / self.weights.get(chat, 1.0)
+            self.finish[chat] = f
+            heapq.heappush(self.heap, (f, next(self.seq), t))
+        self.waiting += 1
+        try:
+            await t.future
+        except asyncio.CancelledError as e:
+            if t.future.done() and not t.future.cancelled():
+                # 已经拿到了名额才被取消，把名额还回去
+                self.release()
+            else:
+                t.cancelled = True
+                self.waiting -= 1
+            raise e
+
+    def release(self) -> None:
+        self.running -= 1
+        self._dispatch()
+
+    def _next(self) -> Optional[_ticket]:
+        while self.priority:
+            t = self.priority.popleft()
+            if not t.cancelled:
+                return t
+        while self.heap:
+            f, _, t = heapq.heappop(self.heap)
+            if self.finish.get(t.chat) == f:
+                # 这个chat已经没有排在后面的请求了
+                del self.finish[t.chat]
+            if t.cancelled:
+                continue
+            self.vtime = f
+            return t
+        return None
+
+    def _dispatch(self) -> None:
+        while self.running < self.concurrency:
+            t = self._next()
+            if t is None:
+                return
+            self.waiting -= 1
+            self.running += 1
+            self._admit(time.monotonic() - t.enqueued)
+            t.future.set_result(None)
+
+    def _admit(self, wait: float) -> None:
+        self.admitted += 1
+        self.waits.append(wait)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self.waits)
+        p95 = waits[int(len(waits) * 0.95)] if waits else 0.0
+        return {
+            "sched_running": self.running,
+            "sched_queued": self.waiting,
+            "sched_admitted": self.admitted,
+            "sched_rejected": self.rejected,
+            "sched_wait_avg_ms": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+            "sched_wait_p95_ms": round(1000 * p95, 1),
+        }
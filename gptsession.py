@@ -0,0 +1,363 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import (Callable, Deque, Dict, Generic, List, Optional, Tuple,
+                    TypeVar)
+
+from utils import botmessages
+
+_VT = TypeVar("_VT")
+
+
+class GptSessionNotFoundException(Exception):
+    ...
+
+
+class GptSessionExpiredException(GptSessionNotFoundException):
+    ...
+
+
+class _sessionEntry(Generic[_VT]):
+    __slots__ = ["value", "keys", "lastaccess"]
+
+    def __init__(self, value: _VT) -> None:
+        self.value = value
+        self.keys: List[botmessages] = []
+        self.lastaccess = time.monotonic()
+
+
+class sessionStore(Generic[_VT]):
+    """
+    有界的会话存储，按LRU和空闲TTL淘汰。
+    一个会话可以有多个key（对话链中每条bot消息都是一个key），
+    淘汰时同一会话的所有key一起删除。被淘汰的key会在有限的时间内留下记录，
+    再次查询时抛出`GptSessionExpiredException`而非`GptSessionNotFoundException`.
+
+    这个类不是线程安全的，调用者需要自己加锁。
+    """
+
+    def __init__(self, maxentries: int, ttl: float) -> None:
+        self.maxentries = maxentries
+        self.ttl = ttl
+        self.index: Dict[botmessages, _sessionEntry[_VT]] = {}
+        self.entries: "OrderedDict[int, _sessionEntry[_VT]]" = OrderedDict()
+        self.expired: "OrderedDict[botmessages, None]" = OrderedDict()
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+        self.evicted_keys = 0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: botmessages) -> bool:
+        return key in self.index
+
+    def get(self, key: botmessages) -> _VT:
+        self._expire()
+        entry = self.index.get(key)
+        if entry is None:
+            if key in self.expired:
+                raise GptSessionExpiredException("session expired")
+            raise GptSessionNotFoundException("session not found")
+        entry.lastaccess = time.monotonic()
+        self.entries.move_to_end(id(entry))
+        return entry.value
+
+    def add(self, key: botmessages, value: _VT) -> None:
+        entry = _sessionEntry(value)
+        self.entries[id(entry)] = entry
+        self._addkey(entry, key)
+        self._shrink()
+
+    def alias(self, key: botmessages, newkey: botmessages) -> _VT:
+        """让`newkey`指向`key`所在的会话，返回该会话"""
+        entry = self.index.get(key)
+        if entry is None:
+            raise GptSessionNotFoundException("session not found")
+        self._addkey(entry, newkey)
+        entry.lastaccess = time.monotonic()
+        self.entries.move_to_end(id(entry))
+        self._shrink()
+        return entry.value
+
+    def sessions(self) -> List[Tuple[_VT, List[botmessages]]]:
+        """所有会话及其key的快照"""
+        return [(entry.value, list(entry.keys)) for entry in self.entries.values()]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "session_keys": len(self.index),
+            "sessions": len(self.entries),
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+            "evicted_keys": self.evicted_keys,
+        }
+
+    def _addkey(self, entry: _sessionEntry[_VT], key: botmessages) -> None:
+        old = self.index.get(key)
+        if old is entry:
+            return
+        if old is not None:
+            old.keys.remove(key)
+        self.expired.pop(key, None)
+        self.index[key] = entry
+        entry.keys.append(key)
+
+    def _evict(self, entry: _sessionEntry[_VT]) -> None:
+        del self.entries[id(entry)]
+        for key in entry.keys:
+            if self.index.get(key) is entry:
+                del self.index[key]
+            self.expired[key] = None
+        self.evicted_keys += len(entry.keys)
+        while len(self.expired) > self.maxentries:
+            self.expired.popitem(last=False)
+
+    def _expire(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        while self.entries:
+            entry = next(iter(self.entries.values()))
+            if entry.lastaccess >= deadline:
+                break
+            self._evict(entry)
+            self.evicted_ttl += 1
+
+    def _shrink(self) -> None:
+        self._expire()
+        while len(self.index) > self.maxentries and len(self.entries) > 1:
+            self._evict(next(iter(self.entries.values())))
+            self.evicted_lru += 1
+
+
+class sessionIndex(object):
+    """
+    `(chat, msgid) -> (bridge endpoint, sid, 会话创建时间)`的持久化索引，重启后对话链仍然可以继续。
+    写入只放进内存中的待写表，由后台线程批量写入sqlite；
+    数据库在第一次用到时才打开，查询只按主键取单条记录，启动时不做全表扫描。
+    """
+
+    def __init__(self, dbpath: str, ttl: float, flushinterval: float = 1.0) -> None:
+        self.database = dbpath
+        self.ttl = ttl
+        self.flushinterval = flushinterval
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.dblock = threading.Lock()
+        # key -> (endpoint, sid, 记录时间, 会话创建时间)
+        self.pending: Dict[botmessages, Tuple[str, int, float, float]] = {}
+        self.inflight: Dict[botmessages, Tuple[str, int, float, float]] = {}
+        self.wakeup = threading.Event()
+        self.writer: Optional[threading.Thread] = None
+        self.stopped = False
+        self.written = 0
+        self.lookups = 0
+        self.hits = 0
+        self.lastprune = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.database, check_same_thread=False)
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS SESSIONS
+                (CHAT    INT     NOT NULL,
+                MSGID   INT     NOT NULL,
+                SID     INT     NOT NULL,
+                TS      REAL    NOT NULL,
+                ENDPOINT TEXT,
+                CREATED REAL,
+                PRIMARY KEY (CHAT, MSGID));"""
+            )
+            columns = [row[1] for row in self.conn.execute(
+                "PRAGMA table_info(SESSIONS);")]
+            if "ENDPOINT" not in columns:
+                # 旧版本创建的表，记录的都是唯一的那个bridge
+                self.conn.execute(
+                    "ALTER TABLE SESSIONS ADD COLUMN ENDPOINT TEXT;")
+            if "CREATED" not in columns:
+                # 旧版本的记录没有创建时间，读取时用记录时间代替
+                self.conn.execute(
+                    "ALTER TABLE SESSIONS ADD COLUMN CREATED REAL;")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS SESSIONS_TS ON SESSIONS(TS);")
+            self.conn.commit()
+        return self.conn
+
+    def put(self, key: botmessages, endpoint: str, sid: int, created: float) -> None:
+        """`created`是bridge会话的创建时间，而不是这个key的写入时间"""
+        with self.lock:
+            if self.stopped:
+                return
+            self.pending[key] = (endpoint, sid, time.time(), created)
+            if self.writer is None:
+                self.writer = threading.Thread(
+                    target=self._writeloop, name="session-index-writer", daemon=True)
+                self.writer.start()
+
+    def get(self, key: botmessages) -> Optional[Tuple[Optional[str], int, float, float]]:
+        """
+        返回`(endpoint, sid, 记录时间, 会话创建时间)`，没有记录时返回None。
+        旧版本的记录endpoint为None，创建时间为记录时间。
+        """
+        self.lookups += 1
+        with self.lock:
+            ans = self.pending.get(key) or self.inflight.get(key)
+        if ans is not None:
+            self.hits += 1
+            return ans
+        with self.dblock:
+            row = self._connect().execute(
+                "SELECT ENDPOINT, SID, TS, CREATED FROM SESSIONS WHERE CHAT=? AND MSGID=?;",
+                (key.chat, key.msgid),
+            ).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return row[0], row[1], row[2], row[2] if row[3] is None else row[3]
+
+    def expired(self, ts: float) -> bool:
+        return time.time() - ts > self.ttl
+
+    def flush(self) -> None:
+        with self.dblock:
+            with self.lock:
+                batch = self.inflight = self.pending
+                self.pending = {}
+            if not batch:
+                return
+            try:
+                conn = self._connect()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO SESSIONS(CHAT, MSGID, SID, TS, ENDPOINT, CREATED) VALUES(?, ?, ?, ?, ?, ?);",
+                    [(k.chat, k.msgid, sid, ts, endpoint, created)
+                     for k, (endpoint, sid, ts, created) in batch.items()],
+                )
+                now = time.time()
+                if now - self.lastprune > self.ttl:
+                    conn.execute(
+                        "DELETE FROM SESSIONS WHERE TS < ?;", (now - self.ttl,))
+                    self.lastprune = now
+                conn.commit()
+            except sqlite3.Error as e:
+                # 写入失败时放回待写表，下次再试
+                with self.lock:
+                    batch.update(self.pending)
+                    self.pending = batch
+                    self.inflight = {}
+                raise e
+            with self.lock:
+                self.inflight = {}
+        self.written += len(batch)
+
+    def _writeloop(self) -> None:
+        while not self.stopped:
+            self.wakeup.wait(self.flushinterval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                ...
+
+    def close(self) -> None:
+        with self.lock:
+            self.stopped = True
+        self.wakeup.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.flush()
+        with self.dblock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "index_pending": len(self.pending),
+            "index_written": self.written,
+            "index_lookups": self.lookups,
+            "index_hits": self.hits,
+        }
+
+
+class sessionIdPool(Generic[_VT]):
+    """
+    预先在bridge上创建好的会话id池。池中的元素是`provision`的返回值。
+    新对话直接从池中取一个已经`/newid`并`/create`过的id，不再付出这两次往返。
+    池中数量低于`lowwater`时唤醒后台线程补充到`size`个。
+    池中的id在bridge上照样会过期，`stale`判断为True的元素在取出时丢弃。
+    """
+
+    def __init__(self, provision: Callable[[], _VT], size: int, lowwater: int,
+                 stale: Optional[Callable[[_VT], bool]] = None) -> None:
+        self.provision = provision
+        self.stale = stale
+        self.size = size
+        self.lowwater = lowwater
+        self.ids: Deque[_VT] = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.filler: Optional[threading.Thread] = None
+        self.stopped = False
+        self.hits = 0
+        self.empty = 0
+        self.provisioned = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        if self.size <= 0 or self.filler is not None:
+            return
+        self.filler = threading.Thread(
+            target=self._fillloop, name="session-pool-filler", daemon=True)
+        self.filler.start()
+        self.wakeup.set()
+
+    def pop(self) -> Optional[_VT]:
+        """取出一个预先创建好的id，池为空时返回None"""
+        if self.filler is None:
+            return None
+        with self.lock:
+            sid = self.ids.popleft() if self.ids else None
+            while sid is not None and self.stale is not None and self.stale(sid):
+                self.dropped += 1
+                sid = self.ids.popleft() if self.ids else None
+            if sid is None:
+                self.empty += 1
+            else:
+                self.hits += 1
+            if len(self.ids) < self.lowwater:
+                self.wakeup.set()
+        return sid
+
+    def _fillloop(self) -> None:
+        backoff = 1.0
+        while not self.stopped:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while not self.stopped and len(self.ids) < self.size:
+                try:
+                    sid = self.provision()
+                except Exception:
+                    self.failures += 1
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+                backoff = 1.0
+                with self.lock:
+                    self.ids.append(sid)
+                self.provisioned += 1
+
+    def close(self) -> None:
+        self.stopped = True
+        self.wakeup.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sidpool_ready": len(self.ids),
+            "sidpool_hits": self.hits,
+            "sidpool_empty": self.empty,
+            "sidpool_provisioned": self.provisioned,
+            "sidpool_failures": self.failures,
+            "sidpool_dropped": self.dropped,
+        }
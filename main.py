@@ -47,19 +47,19 @@ class AntaresBot(
                 try:
                     exec(command)
                 except Exception as e:
-                    self.reply(text="执行失败……")
+                    self.reply_nowait(text="执行失败……")
                     raise e
-                self.reply(text="执行成功～")
+                self.reply_nowait(text="执行成功～")
             else:
                 try:
                     exec("t=" + command)
                     ans = locals()["t"]
                 except Exception as e:
-                    self.reply(text="执行失败……")
+                    self.reply_nowait(text="执行失败……")
                     raise e
-                self.reply(text=f"执行成功，返回值：{ans}")
+                self.reply_nowait(text=f"执行成功，返回值：{ans}")
         except (TypeError, ValueError):
-            self.reply(text="唔……似乎参数不对呢")
+            self.reply_nowait(text="唔……似乎参数不对呢")
         except Exception as e:
             raise e
 
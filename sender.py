@@ -0,0 +1,300 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, TimedOut
+
+# 发送优先级，数值小的先发
+SEND_INTERACTIVE = 0
+SEND_BACKGROUND = 1
+
+
+class tokenBucket(object):
+    """令牌桶：每秒补充`rate`个令牌，最多攒`capacity`个"""
+    __slots__ = ["rate", "capacity", "tokens", "stamp"]
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """还要等多少秒才有令牌"""
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class sendRequest(object):
+    """
+    一次发送：按顺序调用`method`发送`payloads`中的每一条，
+    `future`的结果是最后一条消息的message id.
+    `method`也可以是`edit_message_text`等编辑方法，编辑和发送在同一个聊天的队列中排队、一起限速。
+    """
+    __slots__ = ["method", "payloads", "priority", "seq",
+                 "index", "attempts", "future", "ans", "enqueued"]
+
+    def __init__(self, method: str, payloads: List[dict], priority: int, seq: int) -> None:
+        self.method = method
+        self.payloads = payloads
+        self.priority = priority
+        self.seq = seq
+        self.index = 0
+        self.attempts = 0
+        self.future: Future = Future()
+        self.ans: Optional[int] = None
+        self.enqueued = time.monotonic()
+
+
+class _chatQueue(object):
+    __slots__ = ["heap", "current", "bucket", "inflight", "queued", "until"]
+
+    def __init__(self, bucket: Optional[tokenBucket]) -> None:
+        # (优先级, 序号, 请求)
+        self.heap: List[Tuple[int, int, sendRequest]] = []
+        # 正在发送的请求，它的各条消息连续发出，不会被别的请求插进来
+        self.current: Optional[sendRequest] = None
+        self.bucket = bucket
+        self.inflight = False
+        # 是否已经在`ready`或`blocked`中
+        self.queued = False
+        # 重试等待到这个时间之前不发送
+        self.until = 0.0
+
+    def head(self) -> Optional[sendRequest]:
+        if self.current is not None:
+            return self.current
+        return self.heap[0][2] if self.heap else None
+
+
+class messageSender(object):
+    """
+    统一的消息发送队列。所有消息先进入各自聊天的队列，由调度线程按优先级取出，
+    通过全局令牌桶（约30条/秒）和每个群的令牌桶（约20条/分钟）限速，再交给线程池调用Bot API.
+    同一个聊天同时只有一条消息在发送，保证顺序；被限速或等待重试的聊天不会挡住其他聊天。
+
+    失败时按错误类型重试：带随机抖动的指数退避，遇到`RetryAfter`时按服务器给出的等待时间，
+    等待期间整个聊天暂停发送。每类错误的重试次数、放弃次数和排队延迟都记在`stats()`中。
+    """
+
+    def __init__(
+        self, bot: Bot, retries: int = 5, backoff: float = 1.0, maxbackoff: float = 60.0,
+        globalrate: float = 30.0, groupperminute: float = 20.0, workers: int = 4,
+    ) -> None:
+        self.bot = bot
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        # 任意一秒内最多发出globalrate+1条。群允许攒3条，分成几段的回答不必每段等3秒，
+        # 任意一分钟内最多groupperminute+3条
+        self.globalbucket = tokenBucket(globalrate, 1.0)
+        self.grouprate = groupperminute / 60
+        self.groupburst = min(3.0, groupperminute)
+        self.chats: Dict[int, _chatQueue] = {}
+        # (优先级, 序号, chat)，可以发送的聊天
+        self.ready: List[Tuple[int, int, int]] = []
+        # (可以发送的时间, 序号, chat)，被限速或等待重试的聊天
+        self.blocked: List[Tuple[float, int, int]] = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.pool = ThreadPoolExecutor(workers, "send")
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+        self.sent = 0
+        self.retried: Dict[str, int] = {}
+        self.failed: Dict[str, int] = {}
+        self.latencies: Deque[float] = deque(maxlen=1000)
+        self.maxlatency = 0.0
+
+    def send(self, payloads: List[dict], method: str = "send_message", priority: int = SEND_INTERACTIVE) -> Future:
+        """把`payloads`放进发送队列，立即返回最后一条消息message id的future"""
+        chat = payloads[0]["chat_id"]
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("消息发送队列已经关闭")
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._loop, name="sender", daemon=True)
+                self.thread.start()
+            req = sendRequest(method, payloads, priority, next(self.counter))
+            state = self.chats.get(chat)
+            if state is None:
+                bucket = tokenBucket(
+                    self.grouprate, self.groupburst) if chat < 0 else None
+                state = self.chats[chat] = _chatQueue(bucket)
+            heapq.heappush(state.heap, (priority, req.seq, req))
+            self._activate(chat, time.monotonic())
+            self.cond.notify()
+        return req.future
+
+    def _activate(self, chat: int, now: float) -> None:
+        """聊天有消息可发时，放进`ready`或`blocked`"""
+        state = self.chats[chat]
+        req = state.head()
+        if state.queued or state.inflight or req is None:
+            return
+        wait = state.until - now
+        if state.bucket is not None:
+            wait = max(wait, state.bucket.delay(now))
+        state.queued = True
+        if wait > 0:
+            heapq.heappush(self.blocked, (now + wait, req.seq, chat))
+        else:
+            heapq.heappush(self.ready, (req.priority, req.seq, chat))
+
+    def _loop(self) -> None:
+        with self.cond:
+            while not self.closed:
+                now = time.monotonic()
+                while self.blocked and self.blocked[0][0] <= now:
+                    chat = heapq.heappop(self.blocked)[2]
+                    self.chats[chat].queued = False
+                    self._activate(chat, now)
+                timeout = self.blocked[0][0] - now if self.blocked else None
+                if self.ready:
+                    wait = self.globalbucket.delay(now)
+                    if wait == 0:
+                        self._dispatch(heapq.heappop(self.ready)[2], now)
+                        continue
+                    timeout = wait if timeout is None else min(timeout, wait)
+                self.cond.wait(timeout)
+
+    def _dispatch(self, chat: int, now: float) -> None:
+        state = self.chats[chat]
+        state.queued = False
+        if state.current is None:
+            state.current = heapq.heappop(state.heap)[2]
+        req = state.current
+        if req.index == 0 and req.attempts == 0:
+            latency = now - req.enqueued
+            self.latencies.append(latency)
+            self.maxlatency = max(self.maxlatency, latency)
+        self.globalbucket.take()
+        if state.bucket is not None:
+            state.bucket.take()
+        state.inflight = True
+        self.pool.submit(self._call, chat, req)
+
+    def _call(self, chat: int, req: sendRequest) -> None:
+        """在线程池中调用Bot API，然后回到调度线程的状态中处理结果"""
+        kwargs = req.payloads[req.index]
+        error: Optional[Exception] = None
+        try:
+            for v in kwargs.values():
+                # 重试上传文件时从头读
+                if hasattr(v, "seek"):
+                    v.seek(0)
+            result = getattr(self.bot, req.method)(**kwargs)
+            # 编辑方法可能返回True而不是Message
+            req.ans = getattr(result, "message_id", kwargs.get("message_id"))
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                # 编辑成和原来一样的内容，当作成功
+                req.ans = kwargs.get("message_id")
+            else:
+                error = e
+        except Exception as e:
+            error = e
+        done = None
+        with self.cond:
+            state = self.chats.get(chat)
+            if state is None:
+                # 队列已经关闭
+                req.future.cancel()
+                return
+            state.inflight = False
+            if error is None:
+                self.sent += 1
+                req.index += 1
+                req.attempts = 0
+                if req.index == len(req.payloads):
+                    state.current = None
+                    done = req
+            else:
+                delay = self._delay(req, kwargs, error)
+                name = error.__class__.__name__
+                if delay is None:
+                    self.failed[name] = self.failed.get(name, 0) + 1
+                    state.current = None
+                    done = req
+                else:
+                    self.retried[name] = self.retried.get(name, 0) + 1
+                    state.until = time.monotonic() + delay
+            now = time.monotonic()
+            if state.head() is None:
+                # 空闲且令牌已经攒满的聊天不必保留，否则删掉会让群绕过限速
+                if state.bucket is None or (state.bucket.delay(now) == 0 and state.bucket.tokens >= state.bucket.capacity):
+                    del self.chats[chat]
+            else:
+                self._activate(chat, now)
+            self.cond.notify()
+        if done is not None and not done.future.done():
+            if error is None:
+                done.future.set_result(done.ans)
+            else:
+                done.future.set_exception(error)
+
+    def _delay(self, req: sendRequest, kwargs: dict, e: Exception) -> Optional[float]:
+        """返回重试前要等待的秒数，None表示放弃"""
+        if isinstance(e, BadRequest):
+            if "Replied message not found" in str(e) and "reply_to_message_id" in kwargs:
+                # 被回复的消息已经删除，不回复它直接发送，不计入重试次数
+                kwargs.pop("reply_to_message_id")
+                return 0.0
+            return None
+        if isinstance(e, ChatMigrated):
+            kwargs["chat_id"] = e.new_chat_id
+            return 0.0
+        if not isinstance(e, (RetryAfter, TimedOut, NetworkError)):
+            return None
+        req.attempts += 1
+        if req.attempts >= self.retries or self.closed:
+            return None
+        if isinstance(e, RetryAfter):
+            return e.retry_after + random.uniform(0, self.backoff)
+        delay = min(self.maxbackoff, self.backoff * 2 ** (req.attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def close(self) -> None:
+        """停止调度线程，还在排队的消息全部取消"""
+        with self.cond:
+            self.closed = True
+            chats, self.chats = self.chats, {}
+            self.ready = []
+            self.blocked = []
+            self.cond.notify()
+        self.pool.shutdown(wait=False)
+        for state in chats.values():
+            for _, _, req in state.heap:
+                req.future.cancel()
+            if state.current is not None and not state.inflight:
+                state.current.future.cancel()
+
+    def stats(self) -> Dict[str, float]:
+        with self.cond:
+            queued = sum(len(s.heap) + (s.current is not None)
+                         for s in self.chats.values())
+            latencies = sorted(self.latencies)
+        ans = {"sent": self.sent, "send_queued": queued}
+        if latencies:
+            n = len(latencies)
+            ans["send_queue_p50_ms"] = round(latencies[n // 2] * 1000, 1)
+            ans["send_queue_p99_ms"] = round(
+                latencies[int(n * 0.99)] * 1000, 1)
+            ans["send_queue_max_ms"] = round(self.maxlatency * 1000, 1)
+        for name, n in sorted(self.retried.items()):
+            ans[f"send_retries_{name}"] = n
+        for name, n in sorted(self.failed.items()):
+            ans[f"send_failures_{name}"] = n
+        return ans
@@ -28,3 +28,24 @@ conn.commit()
 conn.close()
 
 # endregion
+
+# region gpt session index
+conn = sqlite3.connect("data/gpt_session.db")
+c = conn.cursor()
+c.execute(
+    """CREATE TABLE SESSIONS
+        (CHAT    INT     NOT NULL,
+        MSGID   INT     NOT NULL,
+        SID     INT     NOT NULL,
+        TS      REAL    NOT NULL,
+        ENDPOINT TEXT,
+        CREATED REAL,
+        PRIMARY KEY (CHAT, MSGID));"""
+)
+c.execute("CREATE INDEX SESSIONS_TS ON SESSIONS(TS);")
+print("Table created successfully")
+
+conn.commit()
+conn.close()
+
+# endregion
@@ -1,11 +1,16 @@
 # region import
 import datetime
+import itertools
+import queue
+import re
 import sqlite3
 import threading
 import time
 import types
+from collections import OrderedDict
+from concurrent.futures import Future
 from functools import wraps
-from typing import Callable, List
+from typing import Callable, Iterable, List, Optional, Tuple
 
 from numpy.random import default_rng
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
@@ -25,6 +30,10 @@ if TYPE_CHECKING:
 
 # region const
 SECONDS_IN_A_DAY = 24 * 60 * 60
+MAX_MESSAGE_LENGTH = 4096
+PAGE_PREFIX = "page:"
+_HTML_TAG = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>")
+_FENCE = re.compile(r"^[ \t]*```[^\n]*\n?", re.M)
 
 randgenerator = default_rng()
 
@@ -92,6 +101,131 @@ def getTimeStamp() -> int:
     """精确到毫秒的时间戳."""
     return int(1000*(time.time() - (1 << 30)))
 
+
+def _entityEvents(
+    text: str, start: int, end: int, opened: Tuple[Tuple[str, str], ...], mode: str
+) -> List[Tuple[int, int, Tuple[Tuple[str, str], ...]]]:
+    """
+    找出`text[start:end]`中开始或结束实体的标记，返回[(标记起点, 标记终点, 此后未闭合的实体)]，
+    实体表示为(开始标记, 结束标记)。html模式下跟踪标签，其他模式只跟踪代码块。
+    """
+    events = []
+    state = list(opened)
+    if mode == "html":
+        for m in _HTML_TAG.finditer(text, start, end):
+            closer = f"</{m.group(2).lower()}>"
+            if not m.group(1):
+                state.append((m.group(0), closer))
+            else:
+                for i in range(len(state) - 1, -1, -1):
+                    if state[i][1] == closer:
+                        del state[i:]
+                        break
+            events.append((m.start(), m.end(), tuple(state)))
+        return events
+    for m in _FENCE.finditer(text, start, end):
+        if state:
+            state = []
+        else:
+            line = m.group(0)
+            state = [(line if line.endswith("\n") else line + "\n", "```")]
+        events.append((m.start(), m.end(), tuple(state)))
+    return events
+
+
+def _stateAt(events, pos: int, opened):
+    for _, markend, state in reversed(events):
+        if markend <= pos:
+            return state
+    return opened
+
+
+def _closersLength(opened, balance: bool) -> int:
+    if not balance or not opened:
+        return 0
+    # 闭合代码块前可能要补一个换行
+    return sum(len(c) for _, c in opened) + 1
+
+
+def _closeChunk(prefix: str, body: str, opened: Tuple[Tuple[str, str], ...], balance: bool) -> str:
+    if not balance or not opened:
+        return prefix + body
+    closers = "".join(c for _, c in reversed(opened))
+    if closers.startswith("```") and not body.endswith("\n"):
+        closers = "\n" + closers
+    return prefix + body + closers
+
+
+def _chooseCut(text: str, start: int, end: int, limit: int, opened, events, mode: str) -> int:
+    """在`text[start:end]`中选切分点"""
+    # 实体之外的区间，从后往前找空行；区间恰好从闭合标记后的换行开始时，那里也是好的切分点
+    bounds = [(start if not opened else None)] + \
+        [(markend if not state else None) for _, markend, state in events]
+    stops = [m for m, _, _ in events] + [end]
+    for left, right in zip(reversed(bounds), reversed(stops)):
+        if left is None or left >= right:
+            continue
+        blank = text.rfind("\n\n", left, right)
+        if blank != -1:
+            cut = blank + 2
+        elif left > start and text[left - 1] == "\n":
+            cut = left
+        elif left > start and text.startswith("\n", left) and left + 1 <= right:
+            cut = left + 1
+        else:
+            continue
+        if cut - start >= limit // 2:
+            return cut
+        break
+    nl = text.rfind("\n", start, end)
+    if nl != -1:
+        return nl + 1
+    # 一行本身放不下时在行内切分，尽量切在后半段的空格处，html模式下不切断标签和字符实体
+    cut = end
+    space = text.rfind(" ", start + (end - start) // 2, end)
+    if space != -1:
+        cut = space + 1
+    if mode == "html":
+        for left, right in (("<", ">"), ("&", ";")):
+            i = text.rfind(left, start + 1, cut)
+            if i > text.rfind(right, start, cut):
+                cut = i
+    return cut
+
+
+def splitMessage(text: str, limit: int = MAX_MESSAGE_LENGTH, parse_mode: Optional[str] = None) -> List[str]:
+    """
+    把长文本切成不超过`limit`个字符的若干段，总耗时与文本长度成线性。
+    优先在代码块结束处和代码块外的空行处切分，其次在换行处，一行本身放不下时才在行内切分。
+    设置了`parse_mode`时，切分处未闭合的代码块或HTML标签在本段末尾闭合，在下一段开头重新打开。
+    """
+    if len(text) <= limit:
+        return [text]
+    mode = (parse_mode or "").lower()
+    balance = mode in ("markdown", "markdownv2", "html")
+    chunks: List[str] = []
+    start = 0
+    prefix = ""
+    opened: Tuple[Tuple[str, str], ...] = ()
+    while len(prefix) + len(text) - start > limit:
+        room = limit - len(prefix) - _closersLength(opened, balance)
+        while True:
+            end = start + max(room, 1)
+            events = _entityEvents(text, start, end, opened, mode)
+            cut = _chooseCut(text, start, end, limit, opened, events, mode)
+            state = _stateAt(events, cut, opened)
+            over = len(prefix) + cut - start + \
+                _closersLength(state, balance) - limit
+            if over <= 0 or room <= 1:
+                break
+            room -= over
+        chunks.append(_closeChunk(prefix, text[start:cut], state, balance))
+        start = cut
+        opened = state
+        prefix = "".join(o for o, _ in opened) if balance else ""
+    chunks.append(prefix + text[start:])
+    return [c for c in chunks if c.strip()]
+
 # endregion
 
 # region classes
@@ -428,7 +562,23 @@ class workingMethodFilter(object):
 
 
 class databaseManager(object):
+    """
+    sqlite数据库的长连接管理。数据库使用WAL模式：
+    写操作共用一个写连接，由`lock`串行化；每个线程有自己的只读连接，读不会等待写。
+    连接在第一次用到时打开，`close`时全部关闭。
+
+    `insertLater`，`deleteLater`，`executeLater`把修改放进队列后立即返回future，
+    由后台写线程把排队的修改合并成一个事务写入，提交后future才完成。
+    """
     conn: sqlite3.Connection
+    PRAGMAS = (
+        "PRAGMA synchronous=NORMAL;",
+        "PRAGMA busy_timeout=5000;",
+        "PRAGMA temp_store=MEMORY;",
+        "PRAGMA cache_size=-4000;",
+    )
+    # 每个表的增删改查语句各占一条，留足余量
+    STATEMENT_CACHE = 256
 
     def __init__(self, botinstance: "AntaresBot", dbpath: str) -> None:
         self.database = dbpath
@@ -436,157 +586,281 @@ class databaseManager(object):
         self.botinstance = botinstance
         self.tables: List[str] = []
         self.lock = threading.Lock()
+        self.local = threading.local()
+        self.readers: List[sqlite3.Connection] = []
+        self.readerslock = threading.Lock()
+        # 表名 -> (主键, 列名)
+        self.schema: Dict[str, Tuple[str, List[str]]] = {}
+        self.statements: Dict[tuple, str] = {}
+        # (操作, 参数, future)，None表示停止写线程
+        self.mutations: "queue.Queue[Optional[Tuple[str, tuple, Future]]]" = queue.Queue()
+        self.writer: Optional[threading.Thread] = None
+        self.writerlock = threading.Lock()
+        # `changed`专用的连接，data_version只在其他连接提交时改变
+        self.watchconn: Optional[sqlite3.Connection] = None
+        self.watchlock = threading.Lock()
+        self.dataversion: Optional[int] = None
+
+    def _open(self) -> sqlite3.Connection:
+        # 只读连接也可能在关闭时由别的线程关掉
+        conn = sqlite3.connect(
+            self.database, check_same_thread=False, cached_statements=self.STATEMENT_CACHE)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
 
     def connect(self):
-        if self.conn is not None:
-            try:
-                self.conn.close()
-            except Exception:
-                ...
-        self.conn = sqlite3.connect(self.database)
+        """打开写连接，已经打开时什么也不做"""
+        if self.conn is None:
+            self.conn = self._open()
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+
+    def _reader(self) -> sqlite3.Connection:
+        """当前线程的只读连接"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if self.conn is None:
+                # 确保数据库已经切换到WAL模式。写连接打开后不再加锁，持有写锁的线程也能调用
+                with self.lock:
+                    self.connect()
+            conn = self.local.conn = self._open()
+            conn.execute("PRAGMA query_only=ON;")
+            with self.readerslock:
+                self.readers.append(conn)
+        return conn
+
+    def _enqueue(self, op: str, args: tuple) -> Future:
+        future = Future()
+        with self.writerlock:
+            if self.writer is None:
+                self.writer = threading.Thread(
+                    target=self._writeloop, name=f"db-writer:{self.database}", daemon=True)
+                self.writer.start()
+            self.mutations.put((op, args, future))
+        future.add_done_callback(self._reportMutation)
+        return future
+
+    def _reportMutation(self, future: Future) -> None:
+        if future.exception() is not None:
+            self.botinstance.debuginfo(
+                f"写入数据库{self.database}失败：{future.exception()}")
+
+    def insertLater(self, table: str, datadict: dict) -> Future:
+        """与`insertInto`相同，主键已存在时更新，但由后台写线程写入"""
+        return self._enqueue("upsert", (table, datadict))
+
+    def upsertManyLater(self, table: str, manydata: Iterable[dict]) -> Future:
+        """与`upsertMany`相同，但由后台写线程和其他排队的修改一起写入"""
+        return self._enqueue("upsertmany", (table, list(manydata)))
+
+    def deleteLater(self, table: str, where: Optional[Dict[str, Any]] = None) -> Future:
+        return self._enqueue("delete", (table, where))
+
+    def executeLater(self, command: str, args: tuple = ()) -> Future:
+        return self._enqueue("execute", (command, args))
+
+    def changed(self) -> bool:
+        """从上次调用到现在，数据库是否被修改过。第一次调用返回False"""
+        with self.watchlock:
+            if self.watchconn is None:
+                self.watchconn = self._open()
+            version = self.watchconn.execute(
+                "PRAGMA data_version;").fetchone()[0]
+            ans = self.dataversion is not None and version != self.dataversion
+            self.dataversion = version
+            return ans
+
+    def flush(self) -> None:
+        """等待此前排队的修改全部写入"""
+        if self.writer is not None:
+            self._enqueue("flush", ()).result()
+
+    def _apply(self, op: str, args: tuple) -> None:
+        if op == "upsert":
+            table, datadict = args
+            pk = self._getPrimaryKey(table)
+            if pk != "" and pk not in datadict:
+                raise ValueError("插入表的数据必须要有主键")
+            columns = tuple(datadict)
+            command = self._statement(
+                ("upsert", table, columns, pk), lambda: self._upsertStatement(table, columns, pk))
+            self._run(self.conn, command, list(datadict.values()))
+        elif op == "upsertmany":
+            table, manydata = args
+            self._upsertRows(table, manydata, self._getPrimaryKey(table))
+        elif op == "delete":
+            table, where = args
+            command = self._statement(
+                ("delete", table, tuple(where) if where else ()),
+                lambda: f"DELETE FROM {table}{self._where(where)};",
+            )
+            self._run(self.conn, command, list(where.values()) if where else [])
+        elif op == "execute":
+            self._run(self.conn, args[0], list(args[1]))
+            # 和`execute`一样，可能改变了表结构
+            self.schema.clear()
+            self.statements.clear()
+
+    def _writeloop(self) -> None:
+        while True:
+            batch = [self.mutations.get()]
+            while True:
+                try:
+                    batch.append(self.mutations.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [x for x in batch if x is not None]
+            with self.lock:
+                self.connect()
+                try:
+                    for op, args, _ in batch:
+                        self._apply(op, args)
+                    self.conn.commit()
+                    results = [None] * len(batch)
+                except Exception:
+                    # 一个修改出错时回滚，再逐个写入，不连累同一批的其他修改
+                    self.conn.rollback()
+                    results = []
+                    for op, args, _ in batch:
+                        try:
+                            self._apply(op, args)
+                            self.conn.commit()
+                            results.append(None)
+                        except Exception as e:
+                            self.conn.rollback()
+                            results.append(e)
+            for (_, _, future), e in zip(batch, results):
+                if e is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(e)
+            if stop:
+                return
 
     def close(self):
-        if self.conn is not None:
+        """写完排队的修改后关闭所有连接"""
+        with self.writerlock:
+            writer, self.writer = self.writer, None
+            if writer is not None:
+                self.mutations.put(None)
+        if writer is not None:
+            writer.join()
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except Exception:
+                    ...
+                self.conn = None
+        with self.watchlock:
+            if self.watchconn is not None:
+                self.watchconn.close()
+                self.watchconn = None
+                self.dataversion = None
+        with self.readerslock:
+            readers, self.readers = self.readers, []
+        for conn in readers:
             try:
-                self.conn.close()
+                conn.close()
             except Exception:
                 ...
-            self.conn = None
-
-    def _getPrimaryKey(self, table: str) -> str:
-        c = self.conn.cursor()
-        c.execute(f"PRAGMA table_info({table});")
-        for r in c.fetchall():
-            if r[-1] > 0:
-                return r[1]
-        return ""
+        self.local = threading.local()
 
-    def _select(
-        self, table: str, where: Optional[Dict[str, Any]] = None, need: Optional[List[str]] = None
-    ) -> list:
-        parseArgs: List[str] = []
-        command = "SELECT "
-        if need is None:
-            command += "* FROM "
-        else:
-            command += ", ".join(need) + " FROM "
-
-        command += table
-
-        if where is not None:
-            command += " WHERE "
-            l = []
-            for k, v in where.items():
-                thispart = f"{k}="
-                if type(v) is str:
-                    thispart += "?"
-                    parseArgs.append(v)
-                else:
-                    thispart += str(v)
-                l.append(thispart)
-            command += " AND ".join(l)
-
-        command += ";"
+    def _tableInfo(self, table: str) -> Tuple[str, List[str]]:
+        """
+        表的主键和列名，按表缓存。表结构可能改变的`execute`和`executeLater`会清空缓存。
+        总是用当前线程的只读连接查询，写连接上可能正有后台写线程的事务
+        """
+        info = self.schema.get(table)
+        if info is None:
+            rows = self._reader().execute(
+                f"PRAGMA table_info({table});").fetchall()
+            pk = next((r[1] for r in rows if r[-1] > 0), "")
+            info = (pk, [r[1] for r in rows])
+            if rows:
+                self.schema[table] = info
+        return info
 
-        self.botinstance.debuginfo(command)
-        if len(parseArgs) > 0:
-            self.botinstance.debuginfo("parsing args: "+' '.join(parseArgs))
+    def _getPrimaryKey(self, table: str) -> str:
+        return self._tableInfo(table)[0]
 
-        c = self.conn.cursor()
+    def _checkColumns(self, table: str, columns) -> None:
+        known = self._tableInfo(table)[1]
+        for k in columns:
+            if k not in known:
+                raise ValueError(f"表{table}中没有列{k}")
 
-        c.execute(command, parseArgs)
+    def _statement(self, key: tuple, build: Callable[[], str]) -> str:
+        """
+        同一个表、同一组列的语句文本总是相同的，值全部作为参数绑定，
+        sqlite的语句缓存才能复用已经编译好的语句。这里再缓存拼好的文本，省去每次拼接
+        """
+        sql = self.statements.get(key)
+        if sql is None:
+            sql = self.statements[key] = build()
+        return sql
+
+    def _run(self, conn: sqlite3.Connection, command: str, parseArgs: list) -> sqlite3.Cursor:
+        if self.botinstance.debug:
+            self.botinstance.debuginfo(command)
+            if len(parseArgs) > 0:
+                self.botinstance.debuginfo(
+                    "parsing args: "+' '.join(str(x) for x in parseArgs))
+        return conn.execute(command, parseArgs)
+
+    @staticmethod
+    def _where(where: Optional[Dict[str, Any]]) -> str:
+        if not where:
+            return ""
+        return " WHERE " + " AND ".join(f"{k}=?" for k in where)
 
-        return c.fetchall()
+    def _select(
+        self, table: str, where: Optional[Dict[str, Any]] = None, need: Optional[List[str]] = None,
+        conn: Optional[sqlite3.Connection] = None,
+    ) -> list:
+        keys = tuple(where) if where else ()
+        command = self._statement(
+            ("select", table, keys, tuple(need) if need is not None else None),
+            lambda: "SELECT " + ("*" if need is None else ", ".join(need)) +
+            f" FROM {table}{self._where(where)};",
+        )
+        parseArgs = list(where.values()) if where else []
+        return self._run(conn or self.conn, command, parseArgs).fetchall()
 
     def _insert(self, table: str, datadict: dict):
-        c = self.conn.cursor()
-        command = f"INSERT INTO {table}("
-        command2 = f"VALUES("
-        parseArgs: List[str] = []
-        sep = ""
-        for k, v in datadict.items():
-            command += sep + str(k)
-            if type(v) is str:
-                command2 += f"{sep} ?"
-                parseArgs.append(v)
-            else:
-                command2 += sep + " " + str(v)
-            sep = ","
-        command += ")"
-        command2 += ");"
-
-        command += command2
+        def build():
+            self._checkColumns(table, datadict)
+            return f"INSERT INTO {table}({', '.join(datadict)}) VALUES({', '.join('?' * len(datadict))});"
 
-        self.botinstance.debuginfo(command)
-        if len(parseArgs) > 0:
-            self.botinstance.debuginfo("parsing args: "+' '.join(parseArgs))
-        c.execute(command, parseArgs)
+        command = self._statement(("insert", table, tuple(datadict)), build)
+        self._run(self.conn, command, list(datadict.values()))
         self.conn.commit()
 
     def _update(self, table: str, datadict: dict, pkey: str):
-        c = self.conn.cursor()
-
-        command = f"UPDATE {table} SET "
-        parseArgs: List[str] = []
-        sep = ""
-        setlength = 0
-
-        for k, v in datadict.items():
-            if str(k) == pkey:
-                continue
-            setlength += 1
-            command += sep + str(k) + "="
-            if type(v) is str:
-                command += "?"
-                parseArgs.append(v)
-            else:
-                command += str(v)
-            sep = ","
-
-        if setlength == 0:
+        columns = [k for k in datadict if k != pkey]
+        if not columns:
             self.botinstance.debuginfo(
                 "nothing to set, no need to update database")
             return
 
-        command += f" WHERE {pkey}="
-        if type(datadict[pkey]) is str:
-            command += f"?;"
-            parseArgs.append(datadict[pkey])
-        else:
-            command += str(datadict[pkey]) + ";"
-
-        self.botinstance.debuginfo(command)
-        if len(parseArgs) > 0:
-            self.botinstance.debuginfo("parsing args: "+' '.join(parseArgs))
+        def build():
+            self._checkColumns(table, datadict)
+            return f"UPDATE {table} SET {', '.join(f'{k}=?' for k in columns)} WHERE {pkey}=?;"
 
-        c.execute(command, parseArgs)
+        command = self._statement(
+            ("update", table, tuple(datadict), pkey), build)
+        parseArgs = [datadict[k] for k in columns]
+        parseArgs.append(datadict[pkey])
+        self._run(self.conn, command, parseArgs)
         self.conn.commit()
 
     def _delete(self, table: str, where: Optional[Dict[str, Any]] = None):
-        c = self.conn.cursor()
-        cmd = f"DELETE FROM {table}"
-        parseArgs: List[str] = []
-
-        if where is not None:
-            cmd += f" WHERE "
-            l = []
-            for k, v in where.items():
-                thispart = f"{k}="
-                if type(v) is str:
-                    thispart += "?"
-                    parseArgs.append(v)
-                else:
-                    thispart += str(v)
-                l.append(thispart)
-            cmd += " AND ".join(l)
-
-        cmd += ";"
-
-        self.botinstance.debuginfo(cmd)
-        if len(parseArgs) > 0:
-            self.botinstance.debuginfo("parsing args: "+' '.join(parseArgs))
-
-        c.execute(cmd, parseArgs)
+        command = self._statement(
+            ("delete", table, tuple(where) if where else ()),
+            lambda: f"DELETE FROM {table}{self._where(where)};",
+        )
+        self._run(self.conn, command, list(where.values()) if where else [])
         self.conn.commit()
 
     def _seenThisPkey(self, table: str, pk: str, pkeyval):
@@ -609,19 +883,61 @@ class databaseManager(object):
                 self._insert(table, datadict)
 
     def insertMany(self, table: str, manydata: List[dict], no_pkey_check: bool = False):
-        with self:
-            pk = self._getPrimaryKey(table)
-            for data in manydata:
-                upd = False
-                if not no_pkey_check and pk != "":
-                    if pk not in data:
-                        raise ValueError("插入表的数据必须要有主键")
-                    if self._seenThisPkey(table, pk, data[pk]):
-                        upd = True
-                if upd:
-                    self._update(table, data, pk)
-                else:
-                    self._insert(table, data)
+        """有主键时按主键覆盖已有的行，`no_pkey_check`为True时直接插入"""
+        pk = self._getPrimaryKey(table)
+        if no_pkey_check or pk == "":
+            self.upsertMany(table, manydata, conflict=False)
+        else:
+            self.upsertMany(table, manydata)
+
+    def upsertMany(
+        self, table: str, manydata: Iterable[dict], chunksize: Optional[int] = None, conflict: bool = True
+    ) -> int:
+        """
+        批量插入，主键已存在的行更新其余的列。列相同的连续多行用一条`executemany`，
+        全部在一个事务中完成。给出`chunksize`时每这么多行提交一次，
+        提交之间释放写锁，导入很大的数据时不会长时间挡住其他写操作。
+        `conflict`为False时不处理主键冲突。返回写入的行数
+        """
+        pk = self._getPrimaryKey(table) if conflict else ""
+        total = 0
+        rows = iter(manydata)
+        while True:
+            chunk = list(itertools.islice(rows, chunksize)
+                         ) if chunksize else list(rows)
+            if not chunk:
+                return total
+            with self.lock:
+                self.connect()
+                try:
+                    self._upsertRows(table, chunk, pk)
+                    self.conn.commit()
+                except Exception as e:
+                    self.conn.rollback()
+                    raise e
+            total += len(chunk)
+            if not chunksize:
+                return total
+
+    def _upsertRows(self, table: str, rows: List[dict], pk: str) -> None:
+        """列相同的连续多行用一条`executemany`写入，不提交。调用者需要持有写锁"""
+        for columns, group in itertools.groupby(rows, key=lambda d: tuple(d)):
+            if pk != "" and pk not in columns:
+                raise ValueError("插入表的数据必须要有主键")
+            command = self._statement(
+                ("upsert", table, columns, pk), lambda: self._upsertStatement(table, columns, pk))
+            self.conn.executemany(command, [tuple(d.values()) for d in group])
+
+    def _upsertStatement(self, table: str, columns: Tuple[str, ...], pk: str) -> str:
+        self._checkColumns(table, columns)
+        command = f"INSERT INTO {table}({', '.join(columns)}) VALUES({', '.join('?' * len(columns))})"
+        if pk == "":
+            return command + ";"
+        updates = [k for k in columns if k != pk]
+        if not updates:
+            return command + f" ON CONFLICT({pk}) DO NOTHING;"
+        return command + f" ON CONFLICT({pk}) DO UPDATE SET " + \
+            ", ".join(f"{k}=excluded.{k}" for k in updates) + ";"
 
     def select(
         self,
@@ -629,9 +945,7 @@ class databaseManager(object):
         where: Optional[Dict[str, Any]] = None,
         need: Optional[List[str]] = None,
     ) -> list:
-        with self:
-            ans = self._select(table, where, need)
-            return ans
+        return self._select(table, where, need, self._reader())
 
     def execute(self, cmd: List[str]):
         """execute a list of commands."""
@@ -639,6 +953,9 @@ class databaseManager(object):
             for c in cmd:
                 self.conn.cursor().execute(c)
             self.conn.commit()
+            # 可能改变了表结构
+            self.schema.clear()
+            self.statements.clear()
 
     def delete(self, table, where: Optional[Dict[str, Any]] = None):
         with self:
@@ -653,17 +970,60 @@ class databaseManager(object):
         self.connect()
         return True
 
-    def __exit__(self, *args, **kwargs):
-        self.close()
+    def __exit__(self, exc_type, *args, **kwargs):
+        if exc_type is not None and self.conn is not None:
+            # 不要把出错的语句留在下一次写入的事务里
+            self.conn.rollback()
         self.lock.release()
         return True
 
 
+class pagedText(object):
+    """
+    按需分页的长文本。第n页的起点要等前面的页都切好才知道，
+    因此只切到被请求的那一页为止。
+    """
+    __slots__ = ["text", "pagesize", "offsets", "buttons"]
+
+    def __init__(self, text: str, pagesize: int, buttons: Optional[list] = None) -> None:
+        self.text = text
+        self.pagesize = pagesize
+        self.offsets = [0]
+        # 每一页都附带的其他按钮
+        self.buttons = buttons or []
+
+    def _cut(self, start: int) -> int:
+        end = start + self.pagesize
+        if end >= len(self.text):
+            return len(self.text)
+        # 尽量在后半页的换行处断开
+        cut = self.text.rfind("\n", start + self.pagesize // 2, end)
+        return end if cut == -1 else cut + 1
+
+    def page(self, n: int) -> Optional[str]:
+        while len(self.offsets) <= n + 1 and self.offsets[-1] < len(self.text):
+            self.offsets.append(self._cut(self.offsets[-1]))
+        if n < 0 or n + 1 >= len(self.offsets):
+            return None
+        return self.text[self.offsets[n]:self.offsets[n + 1]]
+
+    def hasnext(self, n: int) -> bool:
+        """在`page(n)`之后调用"""
+        return self.offsets[n + 1] < len(self.text)
+
+
 class CallbackDataServer(object):
-    """store callback data in a dict."""
+    """
+    store callback data in a dict.
+    分页发送的长文本也存放在这里，最多保留`maxpages`篇，超出时丢弃最久没有翻过页的。
+    """
 
-    def __init__(self) -> None:
+    def __init__(self, maxpages: int = page_cache_size) -> None:
         self.callbackDataMemory: Dict[str, str] = dict()
+        self.pages: "OrderedDict[int, pagedText]" = OrderedDict()
+        self.maxpages = maxpages
+        self.pageid = 0
+        self.pagelock = threading.Lock()
 
     def getData(self, key: str) -> str:
         ans = dictpop(self.callbackDataMemory, key)
@@ -676,6 +1036,26 @@ class CallbackDataServer(object):
             raise ValueError("callbackData索引已存在")
         self.callbackDataMemory[key] = value
 
+    def setPages(self, text: str, pagesize: int, buttons: Optional[list] = None) -> int:
+        with self.pagelock:
+            self.pageid += 1
+            self.pages[self.pageid] = pagedText(text, pagesize, buttons)
+            while len(self.pages) > self.maxpages:
+                self.pages.popitem(last=False)
+            return self.pageid
+
+    def getPage(self, key: int, n: int) -> Tuple[str, bool, list]:
+        """返回第`n`页（从0开始）的文本，后面是否还有页，以及附带的按钮"""
+        with self.pagelock:
+            doc = self.pages.get(key)
+            if doc is None:
+                raise ValueError("无效的分页索引")
+            self.pages.move_to_end(key)
+            page = doc.page(n)
+            if page is None:
+                raise ValueError("无效的页码")
+            return page, doc.hasnext(n), doc.buttons
+
 
 class handleStatus(object):
     __slots__ = ["block", "normal"]
@@ -748,14 +1128,14 @@ class commandCallbackMethod(object):
         else:
             fakeinstance = self.preExecute(**kwargs)
 
-        inst = self.instance
-        with inst.locks.botlock:
-            if any(
-                x in inst.blacklist
-                for x in (fakeinstance.lastchat, fakeinstance.lastuser)
-            ):
-                fakeinstance.errorInfo("你在黑名单中，无法使用任何功能")
-                return
+        # 黑名单是整体替换的frozenset，读取时不需要加锁
+        blacklist = self.instance.blacklist
+        if any(
+            x in blacklist
+            for x in (fakeinstance.lastchat, fakeinstance.lastuser)
+        ):
+            fakeinstance.errorInfo("你在黑名单中，无法使用任何功能")
+            return
 
         return self.__wrapped__(fakeinstance, *args, **kwargs)
 